@@ -1,4 +1,7 @@
-import sys, struct, os, subprocess, re
+import sys, os, subprocess, re, time
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 # This is a script that returns a list of keyframes that aom would likely place. Port of aom"s C code.
 # It requires an aom first-pass stats file as input. FFMPEG first-pass file is not OK. Default filename is stats.bin.
@@ -9,6 +12,10 @@ import sys, struct, os, subprocess, re
 # All of my contributions to this script are hereby public domain.
 # I retain no rights or control over distribution.
 
+from .util import get_frames, get_fps, seek_args, progress_args, read_progress
+from .cache import fingerprint, aomenc_version
+from .tracing import span
+
 # Fields meanings: <source root>/av1/encoder/firstpass.h
 fields = [
   "frame", "weight", "intra_error", "frame_avg_wavelet_energy",
@@ -19,6 +26,20 @@ fields = [
   "new_mv_count", "duration", "count", "raw_error_stdev"
 ]
 
+# one native double per field, 208 bytes per record
+stats_dtype = np.dtype([(field, "f8") for field in fields])
+
+class FirstPassError(Exception):
+  pass
+
+# memory-maps a first-pass stats file as a structured array, one record per frame
+# the last record written by aomenc is the total of the whole pass
+def load_stats(filename):
+  records = os.stat(filename).st_size // stats_dtype.itemsize
+  if records == 0:
+    return np.zeros(0, dtype=stats_dtype)
+  return np.memmap(filename, dtype=stats_dtype, mode="r", shape=(records,))
+
 def get_second_ref_usage_thresh(frame_count_so_far):
   adapt_upto = 32
   min_second_ref_usage_thresh = 0.085
@@ -34,26 +55,26 @@ def DOUBLE_DIVIDE_CHECK(x):
   else:
     return x + 0.000001
 
-def test_candidate_kf(dict_list, current_frame_index, frame_count_so_far):
-  previous_frame_dict = dict_list[current_frame_index - 1]
-  current_frame_dict = dict_list[current_frame_index]
-  future_frame_dict = dict_list[current_frame_index + 1]
+BOOST_FACTOR = 12.5
+
+# For more documentation on the below, see https://aomedia.googlesource.com/aom/+/8ac928be918de0d502b7b492708d57ad4d817676/av1/encoder/pass2_strategy.c#1897
+MIN_INTRA_LEVEL = 0.25
+INTRA_VS_INTER_THRESH = 2.0
+VERY_LOW_INTER_THRESH = 0.05
+KF_II_ERR_THRESHOLD = 2.5
+ERR_CHANGE_THRESHOLD = 0.4
+II_IMPROVEMENT_THRESHOLD = 3.5
+KF_II_MAX = 128.0
+
+def test_candidate_kf(stats, current_frame_index, frame_count_so_far):
+  previous_frame_dict = stats[current_frame_index - 1]
+  current_frame_dict = stats[current_frame_index]
+  future_frame_dict = stats[current_frame_index + 1]
   
   p = previous_frame_dict
   c = current_frame_dict
   f = future_frame_dict
   
-  BOOST_FACTOR = 12.5
-  
-  # For more documentation on the below, see https://aomedia.googlesource.com/aom/+/8ac928be918de0d502b7b492708d57ad4d817676/av1/encoder/pass2_strategy.c#1897
-  MIN_INTRA_LEVEL = 0.25
-  INTRA_VS_INTER_THRESH = 2.0
-  VERY_LOW_INTER_THRESH = 0.05
-  KF_II_ERR_THRESHOLD = 2.5
-  ERR_CHANGE_THRESHOLD = 0.4
-  II_IMPROVEMENT_THRESHOLD = 3.5
-  KF_II_MAX = 128.0
-  
   qmode = True
   #todo: allow user to set whether we"re testing for constant-q mode keyframe placement or not. it"s not a big difference.
   
@@ -65,52 +86,152 @@ def test_candidate_kf(dict_list, current_frame_index, frame_count_so_far):
   second_ref_usage_thresh = get_second_ref_usage_thresh(frame_count_so_far)
   
   if ((qmode == False) or (frame_count_so_far > 2)) and (c["pcnt_second_ref"] < second_ref_usage_thresh) and (f["pcnt_second_ref"] < second_ref_usage_thresh) and ((c["pcnt_inter"] < VERY_LOW_INTER_THRESH) or ((pcnt_intra > MIN_INTRA_LEVEL) and (pcnt_intra > (INTRA_VS_INTER_THRESH * modified_pcnt_inter)) and ((c["intra_error"] / DOUBLE_DIVIDE_CHECK(c["coded_error"])) < KF_II_ERR_THRESHOLD) and ((abs(p["coded_error"] - c["coded_error"]) / DOUBLE_DIVIDE_CHECK(c["coded_error"]) > ERR_CHANGE_THRESHOLD) or (abs(p["intra_error"] - c["intra_error"]) / DOUBLE_DIVIDE_CHECK(c["intra_error"]) > ERR_CHANGE_THRESHOLD) or ((f["intra_error"] / DOUBLE_DIVIDE_CHECK(f["coded_error"])) > II_IMPROVEMENT_THRESHOLD)))):
-    boost_score = 0.0
-    old_boost_score = 0.0
-    decay_accumulator = 1.0
-    for i in range(0, 16):
-      lnf = dict_list[current_frame_index + 1 + i]
-      next_iiratio = (BOOST_FACTOR * lnf["intra_error"] / DOUBLE_DIVIDE_CHECK(lnf["coded_error"]))
-      if (next_iiratio > KF_II_MAX):
-        next_iiratio = KF_II_MAX
-        
-      #Cumulative effect of decay in prediction quality.
-      if (lnf["pcnt_inter"] > 0.85):
-        decay_accumulator = decay_accumulator * lnf["pcnt_inter"]
-      else:
-        decay_accumulator = decay_accumulator * ((0.85 + lnf["pcnt_inter"]) / 2.0)
-        
-      #Keep a running total.
-      boost_score += (decay_accumulator * next_iiratio)
+    is_keyframe = test_kf_boost(stats, current_frame_index)
+  return is_keyframe
+
+# looks ahead up to 16 frames to check the candidate would get enough boost as a keyframe
+def test_kf_boost(stats, current_frame_index):
+  lookahead = slice(current_frame_index + 1, current_frame_index + 17)
+  intra_error = stats["intra_error"][lookahead].tolist()
+  coded_error = stats["coded_error"][lookahead].tolist()
+  pcnt_inter = stats["pcnt_inter"][lookahead].tolist()
+  pcnt_neutral = stats["pcnt_neutral"][lookahead].tolist()
+
+  boost_score = 0.0
+  old_boost_score = 0.0
+  decay_accumulator = 1.0
+  for i in range(0, 16):
+    next_iiratio = (BOOST_FACTOR * intra_error[i] / DOUBLE_DIVIDE_CHECK(coded_error[i]))
+    if (next_iiratio > KF_II_MAX):
+      next_iiratio = KF_II_MAX
       
-      #Test various breakout clauses.
-      if ((lnf["pcnt_inter"] < 0.05) or (next_iiratio < 1.5) or (((lnf["pcnt_inter"] - lnf["pcnt_neutral"]) < 0.20) and (next_iiratio < 3.0)) or ((boost_score - old_boost_score) < 3.0) or (lnf["intra_error"] < 200)):
-        break
-      old_boost_score = boost_score
+    #Cumulative effect of decay in prediction quality.
+    if (pcnt_inter[i] > 0.85):
+      decay_accumulator = decay_accumulator * pcnt_inter[i]
+    else:
+      decay_accumulator = decay_accumulator * ((0.85 + pcnt_inter[i]) / 2.0)
       
-    #If there is tolerable prediction for at least the next 3 frames then break out else discard this potential key frame and move on
-    if (boost_score > 30.0 and (i > 3)):
-      is_keyframe = 1
-  return is_keyframe
+    #Keep a running total.
+    boost_score += (decay_accumulator * next_iiratio)
+    
+    #Test various breakout clauses.
+    if ((pcnt_inter[i] < 0.05) or (next_iiratio < 1.5) or (((pcnt_inter[i] - pcnt_neutral[i]) < 0.20) and (next_iiratio < 3.0)) or ((boost_score - old_boost_score) < 3.0) or (intra_error[i] < 200)):
+      break
+    old_boost_score = boost_score
+    
+  #If there is tolerable prediction for at least the next 3 frames then break out else discard this potential key frame and move on
+  if (boost_score > 30.0 and (i > 3)):
+    return 1
+  return 0
+
+def double_divide_check(x):
+  return np.where(x < 0, x - 0.000001, x + 0.000001)
+
+# same test as test_candidate_kf for frames [start, end) at once, except for the
+# second ref threshold which depends on frame_count_so_far
+# frames failing the returned mask can never be keyframes
+def candidate_kf_mask(stats, start, end):
+  p = stats[start - 1:end - 1]
+  c = stats[start:end]
+  f = stats[start + 1:end + 1]
+
+  max_thresh = get_second_ref_usage_thresh(32)
+
+  with np.errstate(divide="ignore", invalid="ignore"):
+    pcnt_intra = 1.0 - c["pcnt_inter"]
+    modified_pcnt_inter = c["pcnt_inter"] - c["pcnt_neutral"]
+    c_coded_error = double_divide_check(c["coded_error"])
+
+    error_change = (np.abs(p["coded_error"] - c["coded_error"]) / c_coded_error > ERR_CHANGE_THRESHOLD) \
+      | (np.abs(p["intra_error"] - c["intra_error"]) / double_divide_check(c["intra_error"]) > ERR_CHANGE_THRESHOLD) \
+      | (f["intra_error"] / double_divide_check(f["coded_error"]) > II_IMPROVEMENT_THRESHOLD)
+
+    intra = (c["pcnt_inter"] < VERY_LOW_INTER_THRESH) \
+      | ((pcnt_intra > MIN_INTRA_LEVEL)
+        & (pcnt_intra > INTRA_VS_INTER_THRESH * modified_pcnt_inter)
+        & (c["intra_error"] / c_coded_error < KF_II_ERR_THRESHOLD)
+        & error_change)
+
+  return intra & (c["pcnt_second_ref"] < max_thresh) & (f["pcnt_second_ref"] < max_thresh)
+
+# yields the keyframes in [start, end), same as calling test_candidate_kf on every frame
+# only the frames passing candidate_kf_mask are tested one by one
+def scan_keyframes(stats, start, end, last_keyframe=0):
+  if end <= start:
+    return
+
+  second_ref = stats["pcnt_second_ref"]
+  for i in (np.flatnonzero(candidate_kf_mask(stats, start, end)) + start).tolist():
+    frame_count_so_far = i - last_keyframe
+    if frame_count_so_far <= 2:
+      continue
+
+    second_ref_usage_thresh = get_second_ref_usage_thresh(frame_count_so_far)
+    if second_ref[i] < second_ref_usage_thresh and second_ref[i + 1] < second_ref_usage_thresh and test_kf_boost(stats, i):
+      last_keyframe = i
+      yield i
+
+# returns list of keyframes from first-pass stats
+def get_keyframes_from_stats(stats):
+  #intentionally skipping 0th frame and last 16 frames
+  number_of_frames = len(stats) - 1
+  return [0] + list(scan_keyframes(stats, 1, number_of_frames - 16))
 
-def get_aom_keyframes(src, cb):
+# everything that changes the stats, part of the cache key
+first_pass_args = ["--passes=2", "--pass=1", "--auto-alt-ref=1", "--lag-in-frames=25"]
+
+# starts ffmpeg | aomenc --pass=1 writing the stats to fpf, returns the aomenc process, the ffmpeg process is its .ffmpeg
+# start and frames limit the pass to a range of the source, fps is needed to seek to start
+# proxy_height scales the source down in the same pipe and monochrome drops the chroma planes,
+# either makes the pass cheaper without changing the frame numbers
+def start_first_pass(src, fpf, start=0, frames=None, fps=None, threads=8, proxy_height=None, monochrome=False):
   ffmpeg = ["ffmpeg", "-y",
     "-hide_banner",
-    "-loglevel", "error",
+    "-loglevel", "error"]
+  if start:
+    ffmpeg.extend(seek_args(start, fps))
+  ffmpeg.extend([
     "-i", src,
     "-map", "0:v:0",
     "-strict", "-1",
     "-pix_fmt", "yuv420p",
-    "-vsync", "0",
-    "-f", "yuv4mpegpipe", "-"]
+    "-vsync", "0"])
+  if proxy_height:
+    ffmpeg.extend(["-vf", f"scale=-2:'min({proxy_height},ih)':flags=fast_bilinear"])
+  if frames:
+    ffmpeg.extend(["-frames:v", str(frames)])
+  ffmpeg.extend(["-f", "yuv4mpegpipe", "-"])
 
   aom = ["aomenc", "-",
-    "--ivf", f"--fpf=fpf.log",
-    f"--threads=8", "--passes=2",
-    "--pass=1", "--auto-alt-ref=1",
-    "--lag-in-frames=25",
+    "--ivf", f"--fpf={fpf}",
+    f"--threads={threads}",
+    *first_pass_args,
     "-o", os.devnull]
+  if monochrome:
+    aom.insert(-2, "--monochrome")
   
+  # on posix ffmpeg reports progress on its own pipe and aomenc's output is dropped,
+  # elsewhere the progress is read from aomenc's output as before
+  if os.name == "posix":
+    progress_read, progress_write = os.pipe()
+    ffmpeg[1:1] = progress_args(progress_write)
+    try:
+      ffmpeg_pipe = subprocess.Popen(ffmpeg,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        pass_fds=(progress_write,))
+    finally:
+      os.close(progress_write)
+
+    pipe = subprocess.Popen(aom,
+      stdin=ffmpeg_pipe.stdout,
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL)
+    ffmpeg_pipe.stdout.close()
+    pipe.progress = os.fdopen(progress_read, "rb")
+    pipe.ffmpeg = ffmpeg_pipe
+    return pipe
+
   ffmpeg_pipe = subprocess.Popen(ffmpeg,
     stdout=subprocess.PIPE,
     stderr=subprocess.STDOUT)
@@ -120,6 +241,18 @@ def get_aom_keyframes(src, cb):
     stdout=subprocess.PIPE,
     stderr=subprocess.STDOUT,
     universal_newlines=True)
+  ffmpeg_pipe.stdout.close()
+  pipe.ffmpeg = ffmpeg_pipe
+  return pipe
+
+# reads the progress of a pass from start_first_pass until it ends
+# returns the exit codes of aomenc and ffmpeg
+def read_first_pass_progress(pipe, cb):
+  progress = getattr(pipe, "progress", None)
+  if progress:
+    with progress:
+      read_progress(progress, cb)
+    return pipe.wait(), pipe.ffmpeg.wait()
 
   while True:
     line = pipe.stdout.readline().strip()
@@ -128,30 +261,144 @@ def get_aom_keyframes(src, cb):
       break
 
     match = re.search(r"frame.*?\/([^ ]+?) ", line)
-    if match:
+    if match and cb:
       cb(int(match.group(1)))
 
-  filename = "fpf.log"
+  return pipe.wait(), pipe.ffmpeg.wait()
 
-  number_of_frames = round(os.stat(filename).st_size / 208) - 1
-  dict_list = []
-  keyframes_list = [0]
+# raises FirstPassError unless aomenc and ffmpeg exited 0 and fpf has a record for each of frames plus the total
+# frames None skips the record count
+def check_first_pass(fpf, codes, frames=None):
+  if any(codes):
+    raise FirstPassError(f"first pass failed, aomenc exited with {codes[0]}, ffmpeg with {codes[1]}")
+  records = os.path.getsize(fpf) // stats_dtype.itemsize if os.path.exists(fpf) else 0
+  if records < 2 or (frames is not None and records != frames + 1):
+    raise FirstPassError(f"first pass wrote {records} records, expected {frames + 1 if frames is not None else 'at least 2'}")
 
-  with open(filename, "rb") as file:
-    frameBuf = file.read(208)
-    while len(frameBuf) > 0:
-      stats = struct.unpack("d" * 26, frameBuf)
-      p = dict(zip(fields, stats))
-      dict_list.append(p)
-      frameBuf = file.read(208)
+# chunks > 1 runs the first pass on that many overlapping ranges at once, see first_pass_chunked
+# with a cache the stats are reused while the source, aomenc and the first-pass arguments stay the same
+# the stats are written to fpf.log in workdir
+# proxy_height and monochrome run the pass on a cheaper proxy, see start_first_pass
+# tracer records the first pass and the stats parse as spans
+# raises FirstPassError when the pass fails or its stats don't cover total_frames, nothing is cached then
+def get_aom_keyframes(src, cb, chunks=1, total_frames=None, cache=None, workdir=".", proxy_height=None, monochrome=False, tracer=None):
+  fpf = os.path.join(workdir, "fpf.log")
+  # stats left by an earlier job must never pass for this source's
+  if os.path.exists(fpf):
+    os.unlink(fpf)
 
-  #intentionally skipping 0th frame and last 16 frames
-  frame_count_so_far = 1
-  for i in range(1, number_of_frames - 16):
-    is_keyframe = test_candidate_kf(dict_list, i, frame_count_so_far)
-    if is_keyframe == 1:
-      keyframes_list.append(i)
-      frame_count_so_far = 0
-    frame_count_so_far += 1
-
-  return keyframes_list
+  if cache:
+    key = cache.key("aom", fingerprint(src), aomenc_version(), first_pass_args, max(chunks, 1), proxy_height, monochrome)
+    cached = cache.get(key)
+    if cached:
+      with span(tracer, "stats parse", cached=True):
+        return get_keyframes_from_stats(load_stats(cached))
+
+  with span(tracer, "aom first pass", chunks=chunks):
+    if chunks > 1:
+      try:
+        first_pass_chunked(src, fpf, total_frames if total_frames else get_frames(src), chunks, cb,
+          proxy_height=proxy_height, monochrome=monochrome)
+      except FirstPassError as e:
+        print(f"{e}, running the first pass in one piece")
+        chunks = 1
+    if chunks <= 1:
+      pipe = start_first_pass(src, fpf, proxy_height=proxy_height, monochrome=monochrome)
+      check_first_pass(fpf, read_first_pass_progress(pipe, cb), total_frames)
+
+  if cache:
+    cache.put(key, fpf)
+
+  with span(tracer, "stats parse"):
+    return get_keyframes_from_stats(load_stats(fpf))
+
+# splits the source into chunks ranges and runs the first passes in parallel
+# every range but the first starts overlap frames early so the encoder has settled by the
+# first frame that is kept, the kept records are then stitched into one stats file at fpf
+# seeking assumes a constant frame rate, a range whose pass fails or doesn't have exactly its frames (a seek that
+# landed off a frame) raises FirstPassError
+def first_pass_chunked(src, fpf, total_frames, chunks, cb=None, overlap=60, proxy_height=None, monochrome=False):
+  fps = get_fps(src)
+  # every range needs at least one frame, an empty one would run the first pass on the whole source
+  chunks = max(1, min(chunks, total_frames))
+  bounds = [round(total_frames * i / chunks) for i in range(chunks + 1)]
+  threads = max(1, (os.cpu_count() or 1) // chunks)
+
+  lock = Lock()
+  progress = [0] * chunks
+
+  def on_progress(n, x):
+    with lock:
+      progress[n] = x
+      if cb: cb(sum(progress))
+
+  def run(n):
+    start = max(0, bounds[n] - overlap)
+    pipe = start_first_pass(src, f"{fpf}.{n}", start, bounds[n + 1] - start, fps, threads, proxy_height, monochrome)
+    codes = read_first_pass_progress(pipe, lambda x: on_progress(n, x))
+    return bounds[n] - start, codes
+
+  with ThreadPoolExecutor(max_workers=chunks) as executor:
+    results = list(executor.map(run, range(chunks)))
+
+  parts = []
+  try:
+    for n, (skip, codes) in enumerate(results):
+      check_first_pass(f"{fpf}.{n}", codes, bounds[n + 1] - bounds[n] + skip)
+      # drop the overlap and the total record at the end
+      parts.append(np.array(load_stats(f"{fpf}.{n}")[skip:-1]))
+  finally:
+    for n in range(chunks):
+      if os.path.exists(f"{fpf}.{n}"):
+        os.unlink(f"{fpf}.{n}")
+
+  stats = np.concatenate(parts)
+  stats["frame"] = np.arange(len(stats))
+
+  total = np.zeros(1, dtype=stats_dtype)
+  for field in fields:
+    total[field] = stats[field].sum()
+
+  np.concatenate([stats, total]).tofile(fpf)
+
+# yields keyframes while the first pass is still running
+# a frame is decided as soon as the stats for its 16 frame lookahead have been written,
+# the result is the same list as get_aom_keyframes, raises FirstPassError at the end if the pass failed
+# it runs one uncached pass on its own, split() still waits for get_aom_keyframes
+def iter_aom_keyframes(src, cb=None, poll_interval=0.5, workdir=".", proxy_height=None, monochrome=False):
+  fpf = os.path.join(workdir, "fpf.log")
+  if os.path.exists(fpf):
+    os.unlink(fpf)
+
+  pipe = start_first_pass(src, fpf, proxy_height=proxy_height, monochrome=monochrome)
+  Thread(target=read_first_pass_progress, args=(pipe, cb), daemon=True).start()
+
+  yield 0
+
+  next_frame = 1
+  last_keyframe = 0
+  try:
+    while True:
+      done = pipe.poll() is not None
+
+      if os.path.exists(fpf):
+        stats = load_stats(fpf)
+        # same bound as get_keyframes_from_stats, the stats only grow so it never moves back
+        end = len(stats) - 17
+        for keyframe in scan_keyframes(stats, next_frame, end, last_keyframe):
+          last_keyframe = keyframe
+          yield keyframe
+        next_frame = max(next_frame, end)
+        del stats
+
+      if done: break
+      time.sleep(poll_interval)
+
+    # the keyframes yielded so far are only the start of the source if the pass stopped early
+    codes = pipe.wait(), pipe.ffmpeg.wait()
+    if any(codes):
+      raise FirstPassError(f"first pass failed, aomenc exited with {codes[0]}, ffmpeg with {codes[1]}")
+  finally:
+    for process in (pipe, pipe.ffmpeg):
+      if process.poll() is None:
+        process.kill()
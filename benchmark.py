@@ -0,0 +1,578 @@
+import os, sys, time, tempfile, subprocess, platform, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .aom_keyframes import stats_dtype, load_stats, test_candidate_kf, get_keyframes_from_stats, get_aom_keyframes
+from .scene_detect import get_scene_keyframes
+from .cache import aomenc_version
+from .mkv_keyframes import get_mkv_keyframes_fast, get_mkv_keyframes_enzyme, get_mkv_keyframes_clusters
+from .util import get_frames
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+# writes a first-pass stats file with mostly static frames and a hard cut every ~scene_length frames
+def make_synthetic_stats(filename, frames, scene_length=120, seed=0):
+  rng = np.random.default_rng(seed)
+  stats = np.zeros(frames + 1, dtype=stats_dtype)
+
+  stats["frame"] = np.arange(frames + 1)
+  stats["weight"] = 1.0
+  stats["duration"] = 1.0
+  stats["count"] = 1.0
+  stats["intra_error"] = rng.uniform(500, 3000, frames + 1)
+  stats["coded_error"] = stats["intra_error"] * rng.uniform(0.05, 0.3, frames + 1)
+  stats["pcnt_inter"] = rng.uniform(0.9, 1.0, frames + 1)
+  stats["pcnt_neutral"] = rng.uniform(0.0, 0.3, frames + 1)
+  stats["pcnt_motion"] = rng.uniform(0.0, 1.0, frames + 1)
+  stats["pcnt_second_ref"] = rng.uniform(0.0, 0.15, frames + 1)
+
+  cuts = np.cumsum(rng.integers(scene_length // 4, scene_length * 2, frames // scene_length + 1))
+  cuts = cuts[cuts < frames]
+  stats["pcnt_inter"][cuts] = rng.uniform(0.0, 0.06, len(cuts))
+  stats["coded_error"][cuts] = stats["intra_error"][cuts] * rng.uniform(0.5, 1.0, len(cuts))
+
+  stats.tofile(filename)
+
+# the original one frame at a time loop
+def reference_keyframes(stats):
+  keyframes_list = [0]
+  frame_count_so_far = 1
+  for i in range(1, len(stats) - 1 - 16):
+    if test_candidate_kf(stats, i, frame_count_so_far) == 1:
+      keyframes_list.append(i)
+      frame_count_so_far = 0
+    frame_count_so_far += 1
+  return keyframes_list
+
+def bench_candidates(frames, seed=0):
+  with tempfile.TemporaryDirectory() as tmp:
+    filename = os.path.join(tmp, "fpf.log")
+    make_synthetic_stats(filename, frames, seed=seed)
+
+    start = time.perf_counter()
+    stats = load_stats(filename)
+    keyframes = get_keyframes_from_stats(stats)
+    vectorized = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = reference_keyframes(load_stats(filename))
+    loop = time.perf_counter() - start
+
+    del stats
+
+  return {
+    "frames": frames,
+    "keyframes": len(keyframes),
+    "identical": keyframes == reference,
+    "loop_seconds": loop,
+    "vectorized_seconds": vectorized,
+    "speedup": loop / vectorized if vectorized else None
+  }
+
+# distance from every frame in a to the closest frame in the sorted array b
+def nearest_distance(a, b):
+  i = np.searchsorted(b, a)
+  left = b[np.clip(i - 1, 0, len(b) - 1)]
+  right = b[np.clip(i, 0, len(b) - 1)]
+  return np.minimum(np.abs(a - left), np.abs(a - right))
+
+# how far keyframes are from the reference list
+# a keyframe matches if a reference keyframe is within tolerance frames
+def compare_keyframes(reference, keyframes, tolerance=0):
+  reference = np.asarray(sorted(reference))
+  keyframes = np.asarray(sorted(keyframes))
+  result = {
+    "reference": len(reference),
+    "keyframes": len(keyframes),
+    "exact": int(np.isin(keyframes, reference).sum()),
+    "precision": 0.0,
+    "recall": 0.0,
+    "mean_offset": None
+  }
+  if len(reference) == 0 or len(keyframes) == 0:
+    return result
+
+  distance = nearest_distance(keyframes, reference)
+  result["precision"] = float((distance <= tolerance).mean())
+  result["recall"] = float((nearest_distance(reference, keyframes) <= tolerance).mean())
+  result["mean_offset"] = float(distance.mean())
+  return result
+
+def bench_chunked(src, chunks, tolerance=2):
+  total_frames = get_frames(src)
+
+  start = time.perf_counter()
+  reference = get_aom_keyframes(src, None)
+  single = time.perf_counter() - start
+
+  start = time.perf_counter()
+  keyframes = get_aom_keyframes(src, None, chunks, total_frames)
+  chunked = time.perf_counter() - start
+
+  return {
+    "frames": total_frames,
+    "chunks": chunks,
+    "single_seconds": single,
+    "chunked_seconds": chunked,
+    "speedup": single / chunked if chunked else None,
+    "agreement": compare_keyframes(reference, keyframes, tolerance)
+  }
+
+# speed against keyframe agreement for first passes on downscaled proxies
+def bench_proxy(src, heights, monochrome=False, tolerance=2):
+  start = time.perf_counter()
+  reference = get_aom_keyframes(src, None)
+  full = time.perf_counter() - start
+
+  results = []
+  for height in heights:
+    start = time.perf_counter()
+    keyframes = get_aom_keyframes(src, None, proxy_height=height, monochrome=monochrome)
+    seconds = time.perf_counter() - start
+
+    results.append({
+      "height": height,
+      "monochrome": monochrome,
+      "seconds": seconds,
+      "speedup": full / seconds if seconds else None,
+      "agreement": compare_keyframes(reference, keyframes, tolerance)
+    })
+
+  return {"full_seconds": full, "keyframes": len(reference), "proxies": results}
+
+# time to keyframes for the matroska parsers on one file
+def bench_mkv(src, repeat=3):
+  parsers = {
+    "seekhead": get_mkv_keyframes_fast,
+    "enzyme": get_mkv_keyframes_enzyme,
+    "clusters": get_mkv_keyframes_clusters
+  }
+
+  results = {}
+  for name, parser in parsers.items():
+    seconds = []
+    for i in range(repeat):
+      start = time.perf_counter()
+      try:
+        keyframes, total_frames = parser(src)
+      except Exception as e:
+        keyframes, total_frames = None, repr(e)
+      seconds.append(time.perf_counter() - start)
+
+    results[name] = {
+      "seconds": min(seconds),
+      "keyframes": len(keyframes) if keyframes else None,
+      "total_frames": total_frames,
+      "result": keyframes
+    }
+
+  reference = results["enzyme"]
+  for name, result in results.items():
+    result["identical"] = result["result"] == reference["result"] and result["total_frames"] == reference["total_frames"]
+    result["speedup"] = reference["seconds"] / result["seconds"] if result["seconds"] else None
+  for result in results.values():
+    del result["result"]
+
+  return {"file": src, "size": os.path.getsize(src), "parsers": results}
+
+# the original linear scans, to check the bisect versions against
+def reference_apply_max_dist(aom_keyframes, min_dist, max_dist, mkv_keyframes=[], tolerance=5):
+  final_kf = [aom_keyframes[0]]
+  for i in range(len(aom_keyframes) - 1):
+    frame = aom_keyframes[i]
+    next_frame = aom_keyframes[i + 1]
+    length = next_frame - frame
+
+    while length > max_dist:
+      if length - max_dist >= max_dist:
+        candidate_kfs = [(f2, abs(frame + max_dist - f2)) for f2 in mkv_keyframes if abs(frame + max_dist - f2) < tolerance]
+        if len(candidate_kfs) > 0:
+          frame = sorted(candidate_kfs, key=lambda x: x[1])[0][0]
+        else:
+          frame += max_dist
+
+        length = next_frame - frame
+        final_kf.append(frame)
+      elif int(length / 2) > min_dist:
+        candidate_kfs = [(f2, abs(frame + int(length / 2) - f2)) for f2 in mkv_keyframes if abs(frame + int(length / 2) - f2) < tolerance]
+        if len(candidate_kfs) > 0:
+          frame = sorted(candidate_kfs, key=lambda x: x[1])[0][0]
+        else:
+          frame += int(length / 2)
+
+        length = next_frame - frame
+        final_kf.append(frame)
+      else: break
+
+    final_kf.append(next_frame)
+
+  return final_kf
+
+def reference_partition_with_mkv(aom_keyframes, mkv_keyframes, total_frames):
+  mkv_keyframes = mkv_keyframes + [total_frames]
+
+  splits = {}
+  last_end = 0
+  frames = []
+  segments = {}
+
+  for i in range(len(aom_keyframes) - 1):
+    frame = aom_keyframes[i]
+    next_frame = aom_keyframes[i+1]
+    segment_n = len(frames)
+    start = 0
+    length = next_frame - frame
+    if frame in mkv_keyframes:
+      frames.append(frame)
+    else:
+      largest = 0
+      for j in mkv_keyframes:
+        if j < frame:
+          largest = j
+        else:
+          break
+      start = frame - largest
+      if largest in frames or largest < last_end:
+        segment_n -= 1
+        start = frame - frames[len(frames)-1]
+      else:
+        frames.append(largest)
+
+    splits[f"{len(splits):05d}"] = ({"segment": f"{segment_n:05d}.mkv", "start": start, "frames": length, "filesize": 0})
+    last_end = frame + length
+
+  for segment_n in range(len(frames)):
+    segments[f"{segment_n:05d}.mkv"] = {
+      "start": frames[segment_n],
+      "length": (total_frames if segment_n == len(frames) - 1 else frames[segment_n + 1]) - frames[segment_n]
+    }
+
+  return frames, splits, segments
+
+# source keyframes every ~gop frames and scene keyframes every ~scene frames,
+# half of the scenes start on a source keyframe, returns aom keyframes ending with total_frames, mkv keyframes
+def make_synthetic_keyframes(frames, gop=48, scene=120, seed=0):
+  rng = np.random.default_rng(seed)
+
+  mkv = np.cumsum(rng.integers(gop // 2, gop * 2, frames // (gop // 2) + 1))
+  mkv = np.concatenate([[0], mkv[mkv < frames]])
+
+  aom = np.cumsum(rng.integers(scene // 10, scene * 4, frames // (scene // 10) + 1))
+  aom = aom[aom < frames]
+  snap = rng.random(len(aom)) < 0.5
+  aom[snap] = mkv[np.clip(np.searchsorted(mkv, aom[snap]), 0, len(mkv) - 1)]
+  aom = np.unique(np.concatenate([[0], aom]))
+
+  return aom.tolist() + [frames], mkv.tolist()
+
+def time_partition(apply_max_dist, partition_with_mkv, aom, mkv, frames, min_dist, max_dist):
+  start = time.perf_counter()
+  keyframes = apply_max_dist(aom, min_dist, max_dist, mkv)
+  result = partition_with_mkv(keyframes, mkv, frames)
+  return (keyframes, result), time.perf_counter() - start
+
+# the bisect partitioners on frames, and against the linear scans on reference_frames
+# (the scans are quadratic in the number of keyframes)
+def bench_partition(frames=1000000, reference_frames=100000, min_dist=24, max_dist=240, seed=0):
+  from .split import apply_max_dist, partition_with_mkv
+
+  aom, mkv = make_synthetic_keyframes(reference_frames, seed=seed)
+  new, new_seconds = time_partition(apply_max_dist, partition_with_mkv, aom, mkv, reference_frames, min_dist, max_dist)
+  reference, reference_seconds = time_partition(reference_apply_max_dist, reference_partition_with_mkv, aom, mkv, reference_frames, min_dist, max_dist)
+
+  aom, mkv = make_synthetic_keyframes(frames, seed=seed)
+  result, seconds = time_partition(apply_max_dist, partition_with_mkv, aom, mkv, frames, min_dist, max_dist)
+
+  return {
+    "reference_frames": reference_frames,
+    "identical": new == reference,
+    "reference_seconds": reference_seconds,
+    "bisect_seconds": new_seconds,
+    "speedup": reference_seconds / new_seconds if new_seconds else None,
+    "frames": frames,
+    "mkv_keyframes": len(mkv),
+    "aom_keyframes": len(aom),
+    "segments": len(result[1][2]),
+    "seconds": seconds
+  }
+
+# segment lengths of the greedy and optimal partitioners on synthetic keyframes, the optimal one picks its cuts for
+# workers, makespan assumes encode time is proportional to length
+def bench_balance(frames=200000, min_frames=24, max_frames=240, workers=16, seed=0):
+  from .split import partition, makespan
+
+  aom, mkv = make_synthetic_keyframes(frames, seed=seed)
+  aom = aom[:-1]
+  results = {"frames": frames, "min_frames": min_frames, "max_frames": max_frames, "workers": workers}
+
+  for partitioner in ["greedy", "optimal"]:
+    start = time.perf_counter()
+    options = {"workers": workers} if partitioner == "optimal" else None
+    _, splits, _, _ = partition(list(aom), mkv, frames, min_frames, max_frames, partitioner=partitioner,
+      partitioner_options=options)
+    seconds = time.perf_counter() - start
+
+    lengths = np.array([split["frames"] for split in splits.values()])
+    cuts = np.cumsum(lengths)[:-1]
+    results[partitioner] = {
+      "seconds": seconds,
+      "segments": len(lengths),
+      "mean": float(lengths.mean()),
+      "std": float(lengths.std()),
+      "shortest": int(lengths.min()),
+      "longest": int(lengths.max()),
+      "scene_cuts": float(np.isin(cuts, aom).mean()) if len(cuts) else 1.0,
+      "makespan": makespan(lengths.tolist(), workers),
+      "ideal_makespan": frames / workers
+    }
+
+  return results
+
+# scenes of the generated test clip, every scene starts with a cut
+# a fade fades the scene in from or out to black over fade frames
+default_scenes = [
+  {"source": "testsrc2", "frames": 96},
+  {"source": "mandelbrot", "frames": 96},
+  {"source": "color=c=0x404040", "frames": 72},
+  {"source": "smptehdbars", "frames": 96, "fade": "in"},
+  {"source": "life=mold=10:ratio=0.5", "frames": 96},
+  {"source": "cellauto=rule=110", "frames": 96, "fade": "out"},
+  {"source": "rgbtestsrc", "frames": 72},
+  {"source": "testsrc", "frames": 120, "fade": "in"}
+]
+
+# renders scenes with ffmpeg's lavfi sources, returns the reference keyframes
+def make_test_clip(path, scenes=default_scenes, width=640, height=360, fps=24, fade=24):
+  graph = []
+  for i, scene in enumerate(scenes):
+    source = scene["source"] + (":" if "=" in scene["source"] else "=") + f"s={width}x{height}:r={fps}"
+    chain = [source, f"trim=end_frame={scene['frames']}", "setpts=PTS-STARTPTS", f"scale={width}:{height}", "setsar=1", "format=yuv420p"]
+    if scene.get("fade") == "in":
+      chain.append(f"fade=t=in:s=0:n={fade}")
+    elif scene.get("fade") == "out":
+      chain.append(f"fade=t=out:s={scene['frames'] - fade}:n={fade}")
+    graph.append(",".join(chain) + f"[v{i}]")
+
+  graph.append("".join(f"[v{i}]" for i in range(len(scenes))) + f"concat=n={len(scenes)}:v=1:a=0[out]")
+
+  cmd = [
+    "ffmpeg", "-y", "-hide_banner",
+    "-loglevel", "error",
+    "-filter_complex", ";".join(graph),
+    "-map", "[out]",
+    "-c:v", "libx264",
+    "-crf", "16",
+    "-preset", "veryfast",
+    # long gop so the source keyframes don't give the cuts away
+    "-g", "1000",
+    "-x264-params", "scenecut=0",
+    path
+  ]
+  subprocess.run(cmd, check=True)
+
+  return np.cumsum([0] + [scene["frames"] for scene in scenes[:-1]]).tolist()
+
+# runs in a fresh process so the peak memory belongs to this detector alone
+def run_detector(backend, src, total_frames, options):
+  with tempfile.TemporaryDirectory() as workdir:
+    start = time.perf_counter()
+    keyframes = get_scene_keyframes(backend, src, None, total_frames=total_frames, workdir=workdir, **options)
+    seconds = time.perf_counter() - start
+
+  result = {"keyframes": keyframes, "seconds": seconds}
+  if resource:
+    # kilobytes on linux
+    result["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["children_peak_rss"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  return result
+
+def bench_suite(detectors=("aom", "luma"), scenes=default_scenes, tolerance=2, options=None):
+  options = options or {}
+  with tempfile.TemporaryDirectory() as tmp:
+    clip = os.path.join(tmp, "clip.mkv")
+    reference = make_test_clip(clip, scenes)
+    total_frames = sum(scene["frames"] for scene in scenes)
+
+    results = {
+      "clip": {"scenes": scenes, "frames": total_frames, "reference": reference},
+      "environment": {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "aomenc": aomenc_version()
+      },
+      "detectors": {}
+    }
+
+    for backend in detectors:
+      with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        result = executor.submit(run_detector, backend, clip, total_frames, options.get(backend, {})).result()
+
+      result["fps"] = total_frames / result["seconds"] if result["seconds"] else None
+      result["accuracy"] = compare_keyframes(reference, result["keyframes"], tolerance)
+      results["detectors"][backend] = result
+
+  return results
+
+# lists what got worse than the baseline results
+# fps may drop by max_slowdown, precision and recall by max_accuracy_drop
+def find_regressions(baseline, results, max_slowdown=0.1, max_accuracy_drop=0.02):
+  regressions = []
+  for backend, result in results["detectors"].items():
+    if backend not in baseline["detectors"]: continue
+    base = baseline["detectors"][backend]
+
+    if base["fps"] and result["fps"] < base["fps"] * (1 - max_slowdown):
+      regressions.append(f"{backend}: fps {result['fps']:.1f}, baseline {base['fps']:.1f}")
+
+    for metric in ["precision", "recall"]:
+      if result["accuracy"][metric] < base["accuracy"][metric] - max_accuracy_drop:
+        regressions.append(f"{backend}: {metric} {result['accuracy'][metric]:.3f}, baseline {base['accuracy'][metric]:.3f}")
+
+  return regressions
+
+# modules a short cli call or a spawned worker starts from
+entry_points = ["util", "split", "frame_count", "mkv_keyframes", "scene_detect", "degrain", "plot_vmaf", "jobs", "cache"]
+
+# dependencies that should only be imported by the code paths that use them
+heavy_modules = ["numpy", "vapoursynth", "matplotlib", "enzyme"]
+
+import_script = """import sys, time
+start = time.perf_counter()
+import {}
+print(time.perf_counter() - start)
+print(",".join(module for module in {} if module in sys.modules))"""
+
+# imports every entry point in a fresh interpreter, keeps the fastest of repeat runs
+# an entry point fails the budget when its import takes longer than budget seconds or pulls in a heavy module
+def bench_imports(modules=entry_points, repeat=5, budget=0.15):
+  # __name__ is __main__ under python -m, the package is named after the checkout directory
+  package = __package__ or os.path.basename(os.path.dirname(os.path.abspath(__file__)))
+  env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.environ.get("PYTHONPATH")]))}
+
+  results = {}
+  for module in modules:
+    seconds = []
+    for _ in range(repeat):
+      r = subprocess.run([sys.executable, "-c", import_script.format(f"{package}.{module}", heavy_modules)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, check=True)
+      lines = r.stdout.decode("utf-8").splitlines()
+      seconds.append(float(lines[0]))
+      heavy = [name for name in lines[1].split(",") if name] if len(lines) > 1 else []
+
+    results[module] = {
+      "seconds": min(seconds),
+      "heavy": heavy,
+      "within_budget": min(seconds) <= budget and not heavy
+    }
+
+  return results
+
+# this is an example program
+# python3 -m grav1ty.benchmark imports --budget 0.15
+# python3 -m grav1ty.benchmark candidates --frames 2000000
+# python3 -m grav1ty.benchmark chunked 8 source.mkv
+# python3 -m grav1ty.benchmark proxy source.mkv --heights 720 480 360
+# python3 -m grav1ty.benchmark mkv source.mkv
+# python3 -m grav1ty.benchmark partition --frames 1000000
+# python3 -m grav1ty.benchmark balance --min_frames 24 --max_frames 240 --workers 16
+# python3 -m grav1ty.benchmark suite -o results.json --baseline previous.json
+if __name__ == "__main__":
+  import argparse, json
+
+  parser = argparse.ArgumentParser()
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  candidates = commands.add_parser("candidates", help="vectorized keyframe test against the per-frame loop on synthetic stats")
+  candidates.add_argument("--frames", type=int, default=2000000)
+  candidates.add_argument("--seed", type=int, default=0)
+
+  chunked = commands.add_parser("chunked", help="chunked first pass against a single pass")
+  chunked.add_argument("chunks", type=int)
+  chunked.add_argument("source")
+
+  proxy = commands.add_parser("proxy", help="first passes on downscaled proxies against full resolution")
+  proxy.add_argument("source")
+  proxy.add_argument("--heights", type=int, nargs="+", default=[720, 480, 360])
+  proxy.add_argument("--monochrome", action="store_true", help="drop chroma for the proxy passes")
+
+  mkv = commands.add_parser("mkv", help="time to keyframes of the matroska parsers, relative to enzyme")
+  mkv.add_argument("source")
+  mkv.add_argument("--repeat", type=int, default=3)
+
+  partition = commands.add_parser("partition", help="bisect partitioners against the linear scans on synthetic keyframes")
+  partition.add_argument("--frames", type=int, default=1000000)
+  partition.add_argument("--reference_frames", type=int, default=100000, help="frames to compare against the linear scans")
+  partition.add_argument("--seed", type=int, default=0)
+
+  balance = commands.add_parser("balance", help="segment lengths and makespan of the greedy and optimal partitioners")
+  balance.add_argument("--frames", type=int, default=200000)
+  balance.add_argument("--min_frames", type=int, default=24)
+  balance.add_argument("--max_frames", type=int, default=240)
+  balance.add_argument("--workers", type=int, default=16)
+  balance.add_argument("--seed", type=int, default=0)
+
+  imports = commands.add_parser("imports", help="cold import time of every entry point in a fresh interpreter")
+  imports.add_argument("--modules", nargs="+", default=entry_points)
+  imports.add_argument("--repeat", type=int, default=5)
+  imports.add_argument("--budget", type=float, default=0.15, help="seconds an import may take")
+
+  suite = commands.add_parser("suite", help="time and accuracy of the detectors on a generated clip")
+  suite.add_argument("--detectors", nargs="+", default=["aom", "luma"])
+  suite.add_argument("--tolerance", type=int, default=2, help="frames a keyframe may be off and still match")
+  suite.add_argument("-o", dest="output", default=None, help="write the results to this json file")
+  suite.add_argument("--baseline", default=None, help="results json to check for regressions against")
+
+  args = parser.parse_args()
+
+  if args.command == "candidates":
+    result = bench_candidates(args.frames, args.seed)
+    print(json.dumps(result, indent=2))
+    if not result["identical"]:
+      exit(1)
+
+  elif args.command == "chunked":
+    print(json.dumps(bench_chunked(args.source, args.chunks), indent=2))
+
+  elif args.command == "proxy":
+    print(json.dumps(bench_proxy(args.source, args.heights, args.monochrome), indent=2))
+
+  elif args.command == "mkv":
+    print(json.dumps(bench_mkv(args.source, args.repeat), indent=2))
+
+  elif args.command == "partition":
+    result = bench_partition(args.frames, args.reference_frames, seed=args.seed)
+    print(json.dumps(result, indent=2))
+    if not result["identical"]:
+      exit(1)
+
+  elif args.command == "balance":
+    print(json.dumps(bench_balance(args.frames, args.min_frames, args.max_frames, args.workers, args.seed), indent=2))
+
+  elif args.command == "imports":
+    results = bench_imports(args.modules, args.repeat, args.budget)
+    for module, result in results.items():
+      print(f"{module:<14} {result['seconds'] * 1000:7.1f} ms  {', '.join(result['heavy'])}")
+    if not all(result["within_budget"] for result in results.values()):
+      exit(1)
+
+  elif args.command == "suite":
+    results = bench_suite(args.detectors, tolerance=args.tolerance)
+
+    if args.output:
+      json.dump(results, open(args.output, "w+"), indent=2)
+    else:
+      print(json.dumps(results, indent=2))
+
+    for backend, result in results["detectors"].items():
+      accuracy = result["accuracy"]
+      print(f"{backend}: {result['fps']:.1f} fps, precision {accuracy['precision']:.3f}, recall {accuracy['recall']:.3f}", file=sys.stderr)
+
+    if args.baseline:
+      regressions = find_regressions(json.load(open(args.baseline)), results)
+      for regression in regressions:
+        print("regression", regression, file=sys.stderr)
+      if regressions:
+        exit(1)
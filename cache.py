@@ -0,0 +1,91 @@
+import os, re, json, hashlib, shutil, subprocess, tempfile
+from functools import lru_cache
+
+default_path = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "grav1ty")
+
+# identifies a source by its size and samples of its start, middle and end
+# so a moved or copied file still hits without reading all of it
+def fingerprint(src, sample_size=1 << 20):
+  size = os.path.getsize(src)
+  h = hashlib.sha256(str(size).encode())
+  with open(src, "rb") as f:
+    for offset in sorted({0, max(0, size // 2 - sample_size // 2), max(0, size - sample_size)}):
+      f.seek(offset)
+      h.update(f.read(sample_size))
+  return h.hexdigest()
+
+@lru_cache(maxsize=None)
+def aomenc_version(aomenc="aomenc"):
+  try:
+    r = subprocess.run([aomenc, "--help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+  except FileNotFoundError:
+    return None
+  match = re.search(r"AOMedia Project AV1 Encoder (\S+)", r.stdout)
+  return match.group(1) if match else hashlib.sha256(r.stdout.encode()).hexdigest()
+
+# content addressed cache of files on disk
+# entries are evicted least recently used first once the cache grows past max_size bytes
+class Cache:
+  def __init__(self, path=default_path, max_size=20 << 30):
+    self.path = path
+    self.max_size = max_size
+    os.makedirs(path, exist_ok=True)
+
+  def key(self, *parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+  def entry(self, key):
+    return os.path.join(self.path, key)
+
+  # returns the path of the cached file or None, a hit counts as a use
+  def get(self, key):
+    path = self.entry(key)
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      return None
+    return path
+
+  def put(self, key, src):
+    fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, self.entry(key))
+    self.evict()
+    return self.entry(key)
+
+  def get_json(self, key):
+    path = self.get(key)
+    if not path: return None
+    with open(path) as f:
+      return json.load(f)
+
+  def put_json(self, key, data):
+    fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+      json.dump(data, f)
+    os.replace(tmp, self.entry(key))
+    self.evict()
+
+  def evict(self):
+    entries = []
+    for name in os.listdir(self.path):
+      if name.endswith(".tmp"): continue
+      try:
+        stat = os.stat(os.path.join(self.path, name))
+      except FileNotFoundError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name))
+
+    size = sum(e[1] for e in entries)
+    for mtime, entry_size, name in sorted(entries):
+      if size <= self.max_size: break
+      try:
+        os.unlink(os.path.join(self.path, name))
+      except FileNotFoundError:
+        pass
+      size -= entry_size
+
+  def clear(self):
+    for name in os.listdir(self.path):
+      os.unlink(os.path.join(self.path, name))
@@ -0,0 +1,73 @@
+import os, json, hashlib, tempfile
+from .cache import fingerprint
+
+# Manifest of the finished phases of a split job, so an interrupted split() or verify_split() picks up where it stopped.
+# Every phase is stored under a key of its inputs, a phase whose key changed is redone along with the phases after it.
+# Files a phase writes are recorded with their fingerprint when they are done, a file that is missing or changed on
+# disk doesn't count as done.
+
+phases = ["keyframes", "partition", "mux", "verify"]
+
+def phase_key(*parts):
+  return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+class Checkpoint:
+  def __init__(self, path):
+    self.path = path
+    try:
+      with open(path) as f:
+        self.data = json.load(f)
+    except (FileNotFoundError, ValueError):
+      self.data = {}
+
+  # written to a temporary file first so an interrupted save leaves the last manifest
+  def save(self):
+    directory = os.path.dirname(os.path.abspath(self.path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+      json.dump(self.data, f)
+    os.replace(tmp, self.path)
+
+  # returns the data of phase if it was stored under key, otherwise None
+  def get(self, phase, key):
+    entry = self.data.get(phase)
+    if entry and entry["key"] == key:
+      return entry["data"]
+    return None
+
+  # stores phase and drops the phases after it
+  def put(self, phase, key, data=None):
+    for later in phases[phases.index(phase) + 1:]:
+      self.data.pop(later, None)
+    self.data[phase] = {"key": key, "data": data, "files": {}}
+    self.save()
+
+  # starts phase, the files it already finished under the same key are kept
+  def begin(self, phase, key):
+    if not self.data.get(phase) or self.data[phase]["key"] != key:
+      self.put(phase, key)
+
+  # records finished files of phase
+  def add_files(self, phase, paths):
+    files = self.data[phase]["files"]
+    for path in paths:
+      files[os.path.basename(path)] = fingerprint(path)
+    self.save()
+
+  # whether path was finished in phase and hasn't changed since
+  def has_file(self, phase, path):
+    entry = self.data.get(phase)
+    if not entry or os.path.basename(path) not in entry["files"]:
+      return False
+    try:
+      return fingerprint(path) == entry["files"][os.path.basename(path)]
+    except FileNotFoundError:
+      return False
+
+  def clear(self):
+    self.data = {}
+    try:
+      os.unlink(self.path)
+    except FileNotFoundError:
+      pass
@@ -1,9 +1,16 @@
-import os, subprocess, io, re, tempfile
-from threading import Thread, Event
-from queue import Queue
+import os, subprocess, io, re, tempfile, asyncio
+
+try:
+  from .jobs import JobEngine
+  from .tracing import span
+  from .util import index_path, get_fps, seek_args
+except ImportError:
+  from jobs import JobEngine
+  from tracing import span
+  from util import index_path, get_fps, seek_args
 
 # vapoursynth desnoise script
-# adjust accordingly
+# adjust accordingly, the first {} is the input and the second its ffms2 index
 vpy = """
 import vapoursynth as vs
 import mvsfunc as mvf
@@ -11,7 +18,7 @@ import mvsfunc as mvf
 core = vs.get_core()
 core.max_cache_size = 100000
 
-src = core.ffms2.Source("{}")
+src = core.ffms2.Source("{}", cachefile="{}")
 
 y = mvf.BM3D(src, radius1=1, sigma=[12, 0, 0])
 knl = core.knlm.KNLMeansCL(src, a=2, h=1, d=3, device_type='gpu', device_id=0, channels='UV')
@@ -21,38 +28,22 @@ flt = core.std.ShufflePlanes([y, knl], planes=[0, 1, 2], colorfamily=vs.YUV)
 flt.set_output()
 """
 
-def ff_work(q):
-  while True:
-    job = q.get()
-    for cmd in job[0]:
-      subprocess.run(cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    job[1].set()
-    q.task_done()
+# generates the grain table of one segment on a jobs.JobEngine
+# the clean and denoised frames are decoded to fifos read by noise_model, or to files first on windows
+async def grain_job(engine, id, job, noise_model, width, height, block_size, workdir):
+  clean_input, denoised_path, graintable = job
 
-def work(id, q, f_q, noise_model, width, height, block_size, on_complete):
-  e = Event()
-  
-  while True:
-    job = q.get()
-    print("start", id, job[2])
+  async with engine.slot("filter"):
+    print("start", id, graintable)
 
     if os.name == "nt":
-      clean = f"{id}_clean.yuv"
-      denoised = f"{id}_denoise.yuv"
-      cmds = [
-        ["ffmpeg", "-i", job[0], "-y", clean],
-        ["ffmpeg", "-i", job[1], "-y", denoised]
-      ]
-
-      e.clear()
-      f_q.put((cmds, e))
-      e.wait()
-
+      clean = os.path.join(workdir, f"{id}_clean.yuv")
+      denoised = os.path.join(workdir, f"{id}_denoise.yuv")
+      await engine.run(["ffmpeg", *clean_input, "-y", clean], "decode")
+      await engine.run(["ffmpeg", "-i", denoised_path, "-y", denoised], "decode")
     else:
-      clean = os.path.join(tempfile.gettempdir(), f"pipe1_{id}.yuv")
-      denoised = os.path.join(tempfile.gettempdir(), f"pipe2_{id}.yuv")
+      clean = os.path.join(workdir, f"pipe1_{id}.yuv")
+      denoised = os.path.join(workdir, f"pipe2_{id}.yuv")
 
       if os.path.exists(clean):
         os.unlink(clean)
@@ -62,44 +53,61 @@ def work(id, q, f_q, noise_model, width, height, block_size, on_complete):
       os.mkfifo(clean)
       os.mkfifo(denoised)
 
-      cmds = [
-        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", job[0], "-y", clean],
-        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", job[1], "-y", denoised]
-      ]
-
-      [subprocess.Popen(cmd) for cmd in cmds]
-
     noise_model = [
       noise_model if noise_model else "noise_model",
       f"--input={clean}",
       f"--input-denoised={denoised}",
-      f"--output-grain-table={job[2]}",
+      f"--output-grain-table={graintable}",
       f"--width={width}",
       f"--height={height}",
       f"--block-size={block_size}"
     ]
 
-    subprocess.run(noise_model, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    os.unlink(clean)
-    os.unlink(denoised)
-
-    on_complete()
-
-    q.task_done()
-
-def denoise_directory(script, path_src, path_denoise):
+    try:
+      if os.name == "nt":
+        await engine.run(noise_model, None)
+      else:
+        # the decoders block on the fifos until noise_model opens them, so all three run together
+        # inside this job's slot
+        await engine.gather([
+          engine.run(["ffmpeg", "-hide_banner", "-loglevel", "error", *clean_input, "-y", clean], None),
+          engine.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", denoised_path, "-y", denoised], None),
+          engine.run(noise_model, None)
+        ])
+    finally:
+      os.unlink(clean)
+      os.unlink(denoised)
+
+# the generated script is written to workdir
+# tracer gets a span for every file denoised
+# with the segments of a virtual split the segments are read from their source instead of path_src
+def denoise_directory(script, path_src, path_denoise, workdir=".", tracer=None, segments=None):
   os.makedirs(path_denoise, exist_ok=True)
+  script_path = os.path.join(workdir, "tmp_grainremove.vpy")
+
+  if segments:
+    files = list(segments)
+  else:
+    files = [file for file in os.listdir(path_src) if os.path.splitext(file)[1] in [".mkv", ".mp4"]]
 
-  files = [file for file in os.listdir(path_src) if os.path.splitext(file)[1] in [".mkv", ".mp4"]]
   for i, file in enumerate(files, 1):
     if os.path.isfile(os.path.join(path_denoise, file)): continue
-    path = os.path.join(path_src, file)
 
-    with open("tmp_grainremove.vpy", "w+") as f:
-      f.write(script.format(path.replace("\\","\\\\")))
+    if segments:
+      segment = segments[file]
+      path = segment["source"]
+      index = segment["index"]
+      # the script filters the whole source, neighbouring frames outside the segment are still used
+      frames = ["-s", str(segment["start"]), "-e", str(segment["start"] + segment["length"] - 1)]
+    else:
+      path = os.path.join(path_src, file)
+      index = index_path(path)
+      frames = []
+
+    with open(script_path, "w+") as f:
+      f.write(script.format(path.replace("\\","\\\\"), index.replace("\\","\\\\")))
 
-    vspipe = ["vspipe", "tmp_grainremove.vpy", "-", "-y"]
+    vspipe = ["vspipe", script_path, *frames, "-", "-y"]
     ffmpeg = [
       "ffmpeg", "-hide_banner",
       "-i", "-",
@@ -111,15 +119,18 @@ def denoise_directory(script, path_src, path_denoise):
 
     print(f"denoising {i - 1}/{len(files)}", end="\r")
 
-    vspipe = subprocess.Popen(vspipe,
-      stdout=subprocess.PIPE,
-      stderr=subprocess.STDOUT)
+    with span(tracer, "denoise", file=file):
+      vspipe = subprocess.Popen(vspipe,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
 
-    pipe = subprocess.run(ffmpeg,
-      stdin=vspipe.stdout,
-      stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE,
-      universal_newlines=True)
+      pipe = subprocess.run(ffmpeg,
+        stdin=vspipe.stdout,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+      # reaped so its cpu time is counted
+      vspipe.wait()
     
     print(f"denoising {i}/{len(files)}", end="\r")
 
@@ -156,33 +167,54 @@ class Counter:
     self.n += n
     self.cb(self.n)
 
-def generate_models(noise_model, path_split, path_denoise, output, width, height, block_size=40, workers=6):
+# the intermediate yuv files or fifos go to workdir, a temporary directory by default
+# runs workers segments at once on one event loop, tracer gets one span for all of them
+# with the segments of a virtual split the clean frames are decoded from their source instead of path_split
+def generate_models(noise_model, path_split, path_denoise, output, width, height, block_size=40, workers=6, workdir=None, tracer=None,
+  segments=None):
   os.makedirs(output, exist_ok=True)
+  tmp = None if workdir else tempfile.TemporaryDirectory()
+  workdir = workdir if workdir else tmp.name
 
-  queue = Queue()
-  ffmpeg_queue = Queue()
-  total = 0
+  jobs = []
+  fps = {}
 
   for file in os.listdir(path_denoise):
     if os.path.splitext(file)[1] != ".mkv": continue
     
-    path = os.path.join(path_split, file)
     denoised = os.path.join(path_denoise, file)
     graintable = os.path.join(output, f"{os.path.splitext(file)[0]}.table")
 
     if os.path.exists(graintable): continue
-    queue.put((path, denoised, graintable))
+
+    if segments and file in segments:
+      segment = segments[file]
+      if segment["source"] not in fps:
+        fps[segment["source"]] = get_fps(segment["source"])
+      clean_input = [
+        *seek_args(segment["start"], fps[segment["source"]]),
+        "-i", segment["source"],
+        "-frames:v", str(segment["length"])
+      ]
+    else:
+      clean_input = ["-i", os.path.join(path_split, file)]
+    jobs.append((clean_input, denoised, graintable))
   
-  total = queue.qsize()
+  total = len(jobs)
 
   c = Counter(cb=lambda n: print(f"generating grain {n}/{total}", end="\r"))
 
-  for i in range(workers):
-    Thread(target=work, args=(i, queue, ffmpeg_queue, noise_model, width, height, block_size, c.inc), daemon=True).start()
+  # one decode at a time while decoding to files, like before
+  engine = JobEngine({"filter": workers, "decode": 1})
+
+  async def run(id, job):
+    await grain_job(engine, id, job, noise_model, width, height, block_size, workdir)
+    c.inc()
 
-  Thread(target=ff_work, args=(ffmpeg_queue,), daemon=True).start()
+  with span(tracer, "grain generation", segments=total):
+    asyncio.run(engine.gather(run(i, job) for i, job in enumerate(jobs)))
 
-  queue.join()
+  if tmp: tmp.cleanup()
 
 def scale_noise_model(graintable, graintable_mod, scale):
   with open(graintable) as f:
@@ -231,11 +263,12 @@ class Degrain:
 
     parser = argparse.ArgumentParser(
       description="Remove grain from segmented videos\nOnly works for 1 segment per split",
-      usage=f"{os.path.basename(__file__)} degrain [-h] [-s SCRIPT] input output",
+      usage=f"{os.path.basename(__file__)} degrain [-h] [-s SCRIPT] [--segments SEGMENTS] input output",
       formatter_class=argparse.RawTextHelpFormatter
     )
 
     parser.add_argument("-s", "--script", help="Vapoursynth script")
+    parser.add_argument("--segments", help="Segments json of a virtual split, input is ignored")
     parser.add_argument("input", help="Input directory")
     parser.add_argument("output", help="Ouput denoised directory")
 
@@ -260,11 +293,12 @@ class Degrain:
       script = vpy
       print("using default script")
     
-    if not os.path.isdir(args.input):
+    segments = json.load(open(args.segments)) if args.segments else None
+    if not segments and not os.path.isdir(args.input):
       print(args.input, "can't be found")
       exit(1)
 
-    denoise_directory(script, args.input, args.output)
+    denoise_directory(script, args.input, args.output, segments=segments)
   
   def generate(self):
     parser = argparse.ArgumentParser(
@@ -281,6 +315,7 @@ class Degrain:
     parser.add_argument("--blocksize", default=40)
     parser.add_argument("--workers", help=f"default: logical cores / 2 : {round(os.cpu_count()/2)}", default=round(os.cpu_count()/2), required=False)
     parser.add_argument("--noise_model", default=None, help="Location to noise_model example program")
+    parser.add_argument("--segments", help="Segments json of a virtual split, source is ignored")
 
     args = parser.parse_args(sys.argv[2:])
 
@@ -296,7 +331,8 @@ class Degrain:
       int(args.width),
       int(args.height),
       int(args.blocksize),
-      workers=int(args.workers)
+      workers=int(args.workers),
+      segments=json.load(open(args.segments)) if args.segments else None
     )
 
   def scale(self):
@@ -319,5 +355,5 @@ class Degrain:
       scale_noise_model(gt, gt2, float(args.scale))
 
 if __name__ == "__main__":
-  import argparse, sys, shutil
+  import argparse, sys, shutil, json
   Degrain()
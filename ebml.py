@@ -0,0 +1,177 @@
+import mmap
+
+# Minimal EBML reading over a buffer (usually an mmap of the whole file).
+# Only the elements needed to find keyframes are known here.
+# Element ids: https://www.matroska.org/technical/elements.html
+
+EBML = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+INFO = 0x1549A966
+TRACKS = 0x1654AE6B
+CUES = 0x1C53BB6B
+TAGS = 0x1254C367
+CLUSTER = 0x1F43B675
+
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+
+TIMECODE_SCALE = 0x2AD7B1
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+TRACK_UID = 0x73C5
+DEFAULT_DURATION = 0x23E383
+
+CLUSTER_TIMECODE = 0xE7
+SIMPLE_BLOCK = 0xA3
+BLOCK_GROUP = 0xA0
+BLOCK = 0xA1
+REFERENCE_BLOCK = 0xFB
+
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+
+TAG = 0x7373
+TARGETS = 0x63C0
+TAG_TRACK_UID = 0x63C5
+SIMPLE_TAG = 0x67C8
+TAG_NAME = 0x45A3
+TAG_STRING = 0x4487
+
+# level 1 elements, an unknown-sized cluster ends where one of these starts
+top_level = {SEEK_HEAD, INFO, TRACKS, CUES, TAGS, CLUSTER, 0x1941A469, 0x1043A770}
+
+class EBMLError(Exception):
+  pass
+
+def vint_length(first):
+  if first == 0:
+    raise EBMLError("invalid variable length integer")
+  return 9 - first.bit_length()
+
+# element ids keep their length marker
+def read_id(buf, pos):
+  length = vint_length(buf[pos])
+  if length > 4:
+    raise EBMLError(f"invalid element id at {pos}")
+  return int.from_bytes(buf[pos:pos + length], "big"), pos + length
+
+# returns size, position after it, size is None for unknown-sized elements
+def read_size(buf, pos):
+  length = vint_length(buf[pos])
+  value = int.from_bytes(buf[pos:pos + length], "big") & ((1 << (7 * length)) - 1)
+  if value == (1 << (7 * length)) - 1:
+    return None, pos + length
+  return value, pos + length
+
+def read_uint(buf, pos, size):
+  return int.from_bytes(buf[pos:pos + size], "big")
+
+# yields id, data start, data size of every element in [start, end)
+# unknown-sized elements are yielded with size None, the caller has to work out where they end
+def iter_elements(buf, start, end):
+  pos = start
+  while pos < end:
+    id, pos = read_id(buf, pos)
+    size, pos = read_size(buf, pos)
+    yield id, pos, size
+    if size is None:
+      return
+    pos += size
+
+# finds the segment, returns the start and end of its data
+def find_segment(buf):
+  for id, start, size in iter_elements(buf, 0, len(buf)):
+    if id == SEGMENT:
+      return start, len(buf) if size is None else min(start + size, len(buf))
+    if id != EBML or size is None:
+      break
+  raise EBMLError("no segment found")
+
+# reads the SeekHead at the start of the segment, returns {element id: position}
+# positions are relative to the segment data start, a SeekHead pointing to another is followed
+def read_seek_head(buf, start, end):
+  positions = {}
+  pending = []
+
+  for id, pos, size in iter_elements(buf, start, end):
+    if id == SEEK_HEAD:
+      pending.append((pos, size))
+    break
+
+  seen = set()
+  while pending:
+    pos, size = pending.pop()
+    if pos in seen: continue
+    seen.add(pos)
+
+    for id, seek, seek_size in iter_elements(buf, pos, pos + size):
+      if id != SEEK: continue
+      target = position = None
+      for child, child_pos, child_size in iter_elements(buf, seek, seek + seek_size):
+        if child == SEEK_ID:
+          target = read_uint(buf, child_pos, child_size)
+        elif child == SEEK_POSITION:
+          position = read_uint(buf, child_pos, child_size)
+      if target is None or position is None: continue
+
+      if target == SEEK_HEAD:
+        element, data = read_id(buf, start + position)
+        child_size, data = read_size(buf, data)
+        if element == SEEK_HEAD and child_size is not None:
+          pending.append((data, child_size))
+      elif target not in positions:
+        positions[target] = position
+
+  return positions
+
+# finds the level 1 elements in ids, returns {element id: (data start, data size)}
+# jumps straight to them through the SeekHead, anything it doesn't list is searched for by
+# stepping over the level 1 elements, which stops at the first unknown-sized element
+def find_level1(buf, start, end, ids):
+  found = {}
+  for id, position in read_seek_head(buf, start, end).items():
+    if id not in ids or start + position >= end: continue
+    element, data = read_id(buf, start + position)
+    size, data = read_size(buf, data)
+    if element == id and size is not None:
+      found[id] = (data, size)
+
+  if len(found) < len(ids):
+    for id, data, size in iter_elements(buf, start, end):
+      if size is None: break
+      if id in ids and id not in found:
+        found[id] = (data, size)
+        if len(found) == len(ids): break
+
+  return found
+
+# first video track as (track number, track uid, default duration) from the data of a Tracks element
+def find_video_track(buf, start, end):
+  for id, entry, size in iter_elements(buf, start, end):
+    if id != TRACK_ENTRY: continue
+    track = {}
+    for child, pos, child_size in iter_elements(buf, entry, entry + size):
+      if child in (TRACK_TYPE, TRACK_NUMBER, TRACK_UID, DEFAULT_DURATION):
+        track[child] = read_uint(buf, pos, child_size)
+    if track.get(TRACK_TYPE) == 1:
+      return track.get(TRACK_NUMBER), track.get(TRACK_UID), track.get(DEFAULT_DURATION)
+  return None, None, None
+
+# track number, keyframe flag (None for Block), number of frames and timecode relative to the cluster of a
+# (Simple)Block
+def read_block_header(buf, pos):
+  length = vint_length(buf[pos])
+  track = int.from_bytes(buf[pos:pos + length], "big") & ((1 << (7 * length)) - 1)
+  timecode = int.from_bytes(buf[pos + length:pos + length + 2], "big", signed=True)
+  flags = buf[pos + length + 2]
+  frames = buf[pos + length + 3] + 1 if flags & 0x06 else 1
+  return track, flags & 0x80 != 0, frames, timecode
+
+def open_mmap(src):
+  with open(src, "rb") as f:
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
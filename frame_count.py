@@ -0,0 +1,49 @@
+import os, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from . import util
+from .util import get_frames, ffms2_source, get_vs_core, set_index_dir
+from .mkv_keyframes import get_mkv_keyframes_fast, get_mkv_keyframes_clusters
+from .mp4_keyframes import get_mp4_keyframes
+
+# frame counts that don't need any decoding, cheapest first and only as far as they're asked for:
+# the NUMBER_OF_FRAMES tag, the blocks in the mkv clusters or the mp4 sample table, and the ffms2 index
+# or the packets ffmpeg copies without vapoursynth
+def metadata_frame_counts(src):
+  for count in [get_mkv_keyframes_fast, get_mkv_keyframes_clusters, get_mp4_keyframes]:
+    try:
+      total_frames = count(src)[1]
+    except Exception:
+      continue
+    if isinstance(total_frames, int) and total_frames > 0:
+      yield total_frames
+
+  if get_vs_core():
+    yield ffms2_source(get_vs_core(), src).num_frames
+  else:
+    yield get_frames(src)
+
+# stops at the first two counts that agree, decodes when none do or when the only count is ffmpeg's packet count
+def count_frames(src):
+  counts = []
+  for total_frames in metadata_frame_counts(src):
+    if total_frames in counts:
+      return total_frames
+    counts.append(total_frames)
+  if len(counts) == 1 and get_vs_core():
+    return counts[0]
+  return get_frames(src, False)
+
+# counts the frames of many files at once, returns {path: frames}
+def count_frames_batch(paths, workers=None):
+  paths = list(paths)
+  if not paths:
+    return {}
+
+  workers = min(workers or os.cpu_count() or 1, len(paths))
+  if workers == 1:
+    return {path: count_frames(path) for path in paths}
+
+  # spawned workers set up their own vapoursynth core and start with the default index dir
+  with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+    initializer=set_index_dir, initargs=(util.index_dir, util.index_max_size)) as executor:
+    return dict(zip(paths, executor.map(count_frames, paths, chunksize=max(1, len(paths) // (workers * 4)))))
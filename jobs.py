@@ -0,0 +1,144 @@
+import os, asyncio
+
+try:
+  from .util import ProgressReader, with_progress
+except ImportError:
+  from util import ProgressReader, with_progress
+
+# Runs ffmpeg/aomenc/vspipe processes as coroutines on one event loop.
+# Every job takes a slot of a resource class first, so any number of jobs can be queued
+# while only as many processes run as the limits allow.
+# Stages of a pipe are connected by an os pipe, a slow consumer blocks the producer in the kernel
+# and no frames pass through python.
+# A cancelled job kills every process of its chain.
+
+cpus = os.cpu_count() or 1
+
+default_limits = {
+  "decode": cpus,
+  "encode": max(1, cpus // 4),
+  "filter": max(1, cpus // 2)
+}
+
+class JobEngine:
+  def __init__(self, limits=None):
+    self.limits = {**default_limits, **(limits or {})}
+    self.semaphores = {}
+
+  def semaphore(self, resource):
+    if resource not in self.semaphores:
+      if resource not in self.limits:
+        raise ValueError(f"unknown resource class {resource}, available: {', '.join(self.limits)}")
+      self.semaphores[resource] = asyncio.Semaphore(self.limits[resource])
+    return self.semaphores[resource]
+
+  # holds one slot of every resource in resources (a name, a list of names or None) while the block runs
+  # slots are always taken in sorted order so jobs needing several classes can't deadlock
+  def slot(self, resources):
+    if resources is None:
+      resources = []
+    elif isinstance(resources, str):
+      resources = [resources]
+    return Slot([self.semaphore(resource) for resource in sorted(set(resources))])
+
+  # runs cmd, with cb the progress of an ffmpeg cmd is read from -progress
+  # returns the exit code
+  async def run(self, cmd, resource="encode", cb=None, total=None):
+    async with self.slot(resource):
+      if cb:
+        process = await asyncio.create_subprocess_exec(*with_progress(cmd),
+          stdout=asyncio.subprocess.PIPE,
+          stderr=asyncio.subprocess.DEVNULL)
+      else:
+        process = await asyncio.create_subprocess_exec(*cmd,
+          stdout=asyncio.subprocess.DEVNULL,
+          stderr=asyncio.subprocess.DEVNULL)
+
+      try:
+        if cb:
+          await read_progress_async(process.stdout, cb, total)
+        return await process.wait()
+      finally:
+        await kill([process])
+
+  # runs cmd1 | cmd2 where cmd2 is ffmpeg, same as util.ffmpeg_pipe
+  # returns the exit code of cmd2
+  async def pipe(self, cmd1, cmd2, resource="encode", cb=None, total=None):
+    async with self.slot(resource):
+      read, write = os.pipe()
+      processes = []
+      try:
+        processes.append(await asyncio.create_subprocess_exec(*cmd1,
+          stdout=write,
+          stderr=asyncio.subprocess.DEVNULL))
+        processes.append(await asyncio.create_subprocess_exec(*with_progress(cmd2),
+          stdin=read,
+          stdout=asyncio.subprocess.PIPE,
+          stderr=asyncio.subprocess.DEVNULL))
+      except BaseException:
+        await kill(processes)
+        raise
+      finally:
+        os.close(read)
+        os.close(write)
+
+      try:
+        await read_progress_async(processes[1].stdout, cb, total)
+        code = await processes[1].wait()
+        await processes[0].wait()
+        return code
+      finally:
+        await kill(processes)
+
+  # runs the coroutines concurrently and returns their results in order
+  # if one fails the others are cancelled and their processes killed
+  async def gather(self, jobs):
+    tasks = [asyncio.ensure_future(job) for job in jobs]
+    try:
+      return await asyncio.gather(*tasks)
+    except BaseException:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      raise
+
+class Slot:
+  def __init__(self, semaphores):
+    self.semaphores = semaphores
+    self.acquired = []
+
+  async def __aenter__(self):
+    try:
+      for semaphore in self.semaphores:
+        await semaphore.acquire()
+        self.acquired.append(semaphore)
+    except BaseException:
+      self.release()
+      raise
+    return self
+
+  async def __aexit__(self, *args):
+    self.release()
+
+  def release(self):
+    while self.acquired:
+      self.acquired.pop().release()
+
+async def read_progress_async(stream, cb, total=None):
+  reader = ProgressReader(cb, total)
+  async for line in stream:
+    if not reader.feed(line): break
+
+  # keep draining so ffmpeg never blocks on a full pipe
+  while await stream.read(1 << 16): pass
+
+# kills the processes still running and reaps them
+async def kill(processes):
+  for process in processes:
+    if process.returncode is None:
+      try:
+        process.kill()
+      except ProcessLookupError:
+        pass
+  for process in processes:
+    await process.wait()
@@ -0,0 +1,86 @@
+import subprocess
+import numpy as np
+
+# Scene change detection on downscaled luma, no encoder needed.
+# Every frame is scaled to width x height gray by ffmpeg and compared to the previous one with
+# a 64 bin histogram distance and the mean absolute pixel difference.
+# A cut is placed where the score is above threshold and well above the scores just before it,
+# so steady high motion doesn't trigger cuts.
+
+# scores of the transitions between consecutive rows of frames (uint8, one frame per row)
+def frame_scores(frames, bins=64):
+  n = len(frames)
+  if n < 2:
+    return np.zeros(0)
+
+  shift = 8 - int(np.log2(bins))
+  index = (frames >> shift).astype(np.intp) + np.arange(n)[:, None] * bins
+  hist = np.bincount(index.ravel(), minlength=n * bins).reshape(n, bins) / frames.shape[1]
+  hist_diff = np.abs(np.diff(hist, axis=0)).sum(axis=1) / 2
+
+  pixel_diff = np.abs(np.diff(frames.astype(np.int16), axis=0)).mean(axis=1) / 255
+
+  return (hist_diff + pixel_diff) / 2
+
+# picks cuts from the transition scores, scores[i] is the change from frame i to frame i + 1
+def find_cuts(scores, threshold=0.2, ratio=3.0, window=8, min_scene=12):
+  # mean of the window scores before every transition
+  cumsum = np.concatenate([[0.0], np.cumsum(scores)])
+  index = np.arange(len(scores))
+  start = np.maximum(index - window, 0)
+  local = (cumsum[index] - cumsum[start]) / np.maximum(index - start, 1)
+
+  keyframes = [0]
+  for i in np.flatnonzero((scores > threshold) & (scores > ratio * local)).tolist():
+    frame = i + 1
+    if frame - keyframes[-1] >= min_scene:
+      keyframes.append(frame)
+
+  return keyframes
+
+# returns list of keyframes
+def get_luma_keyframes(src, cb=None, width=256, height=144, threshold=0.2, ratio=3.0, window=8, min_scene=12, batch=512):
+  ffmpeg = [
+    "ffmpeg", "-hide_banner",
+    "-loglevel", "error",
+    "-i", src,
+    "-map", "0:v:0",
+    "-vsync", "0",
+    "-vf", f"scale={width}:{height}:flags=area",
+    "-pix_fmt", "gray",
+    "-f", "rawvideo", "-"
+  ]
+
+  pipe = subprocess.Popen(ffmpeg,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL)
+
+  frame_size = width * height
+  scores = []
+  last = None
+  frames_read = 0
+
+  try:
+    while True:
+      buf = pipe.stdout.read(frame_size * batch)
+      if len(buf) < frame_size:
+        break
+
+      frames = np.frombuffer(buf, dtype=np.uint8, count=len(buf) // frame_size * frame_size).reshape(-1, frame_size)
+      frames_read += len(frames)
+
+      # carry the last frame over so the transition between batches is scored too
+      if last is not None:
+        frames = np.concatenate([last[None], frames])
+      scores.append(frame_scores(frames))
+      last = frames[-1]
+
+      if cb: cb(frames_read)
+  finally:
+    pipe.stdout.close()
+    pipe.wait()
+
+  if not scores:
+    return [0]
+
+  return find_cuts(np.concatenate(scores), threshold, ratio, window, min_scene)
@@ -1,5 +1,11 @@
-import subprocess, re, enzyme
-from .util import parse_time, get_frames, vs_core
+import subprocess, re, os, glob, shutil
+from .util import parse_time, get_frames, get_vs_core, index_path, ffms2_source
+from .cache import fingerprint
+from .mp4_keyframes import get_mp4_keyframes
+from .ebml import EBMLError, open_mmap, find_segment, find_level1, find_video_track, iter_elements, read_id, read_size, \
+  read_uint, read_block_header, top_level, INFO, TRACKS, CUES, TAGS, CLUSTER, CLUSTER_TIMECODE, SIMPLE_BLOCK, BLOCK_GROUP, BLOCK, \
+  REFERENCE_BLOCK, TIMECODE_SCALE, CUE_POINT, CUE_TIME, CUE_TRACK_POSITIONS, CUE_TRACK, TAG, TARGETS, \
+  TAG_TRACK_UID, SIMPLE_TAG, TAG_NAME, TAG_STRING
 
 def get_child(parent, *args, is_list=False):
   args = list(args)
@@ -12,33 +18,174 @@ def get_child(parent, *args, is_list=False):
   return [parent] if is_list else parent
 
 # returns list of keyframes, total_frames
-def get_mkv_keyframes(src):
+# with a cache the result is reused for the same source
+def get_mkv_keyframes(src, cache=None):
+  if cache:
+    key = cache.key("mkv", fingerprint(src))
+    cached = cache.get_json(key)
+    if cached:
+      return cached[0], cached[1]
+
+  frames, total_frames = find_mkv_keyframes(src)
+
+  if cache and total_frames:
+    cache.put_json(key, [frames, total_frames])
+
+  return frames, total_frames
+
+def find_mkv_keyframes(src):
   try:
     frames, total_frames = get_mkv_keyframes_fast(src)
   except:
     frames = None
     total_frames = None
 
+  if frames and total_frames:
+    return frames, total_frames
+
+  # container level fallbacks, none of them decode any frames
+  for name, fallback in [
+    ("mkv clusters", get_mkv_keyframes_clusters),
+    ("mp4 sync samples", get_mp4_keyframes),
+    ("ffprobe packets", get_keyframes_ffprobe)
+  ]:
+    try:
+      keyframes = fallback(src)
+      print(f"using {name} for keyframes")
+      return keyframes
+    except Exception:
+      pass
+
   if not frames:
-    if vs_core:
+    if get_vs_core():
       print("attempting to use vapoursynth/ffms2 for keyframes")
-      return get_keyframes_vapoursynth(vs_core, src)
+      return get_keyframes_vapoursynth(get_vs_core(), src)
+    elif shutil.which("ffmsindex"):
+      print("attempting to use the ffms2 index for keyframes")
+      return get_keyframes_ffindex(src)
     else:
       print("falling back to ffmpeg for keyframes")
       return get_mkv_keyframes_slow(src)
   else:
-    if not total_frames:
-      print("falling back to ffmpeg for total frames")
-      total_frames = get_frames(src)
-
-    return frames, total_frames
+    print("falling back to ffmpeg for total frames")
+    return frames, get_frames(src)
 
+# keyframes from the ffms2 index, decodes every frame only if ffmsindex isn't available
 def get_keyframes_vapoursynth(core, src):
-  video = core.ffms2.Source(src)
+  if shutil.which("ffmsindex"):
+    return get_keyframes_ffindex(src)
+
+  video = ffms2_source(core, src)
   frames = [i for i in range(video.num_frames) if video.get_frame(i).props._PictType.decode() == "I"]
   return frames, video.num_frames
 
+# ffmsindex writes the keyframes and timecodes of the track next to the index while indexing,
+# both are kept in the shared index directory so the source is indexed once
+def get_keyframes_ffindex(src):
+  index = index_path(src)
+  keyframes_files = glob.glob(glob.escape(index) + "_track*.kf.txt")
+  timecodes_files = glob.glob(glob.escape(index) + "_track*.tc.txt")
+
+  if not os.path.exists(index) or not keyframes_files or not timecodes_files:
+    subprocess.run(["ffmsindex", "-f", "-k", "-c", src, index],
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL,
+      check=True)
+    keyframes_files = glob.glob(glob.escape(index) + "_track*.kf.txt")
+    timecodes_files = glob.glob(glob.escape(index) + "_track*.tc.txt")
+
+  # the first video track has the lowest track number
+  with open(sorted(keyframes_files)[0]) as f:
+    frames = [int(line) for line in f if line.strip().isdigit()]
+
+  # one timecode per frame after the header comment
+  with open(sorted(timecodes_files)[0]) as f:
+    total_frames = sum(1 for line in f if line.strip() and not line.startswith("#"))
+
+  return frames, total_frames
+
+# reads only Info, Tracks, Cues and Tags, found through the SeekHead
 def get_mkv_keyframes_fast(src):
+  buf = open_mmap(src)
+  try:
+    start, end = find_segment(buf)
+    elements = find_level1(buf, start, end, {INFO, TRACKS, CUES, TAGS})
+
+    timecode_scale = 1000000
+    if INFO in elements:
+      pos, size = elements[INFO]
+      for id, data, data_size in iter_elements(buf, pos, pos + size):
+        if id == TIMECODE_SCALE:
+          timecode_scale = read_uint(buf, data, data_size)
+
+    if TRACKS not in elements:
+      return None, "Unable to find tracks"
+    track_number, track_uid, frame_duration = find_video_track(buf, elements[TRACKS][0], sum(elements[TRACKS]))
+    if not track_number:
+      return None, "Unable to parse track number"
+    if not frame_duration:
+      return None, "Unable to parse frame duration"
+    if not track_uid:
+      return None, "Unable to parse track uid"
+
+    if CUES not in elements:
+      return None, "Unable to find cues"
+
+    timestamps = []
+    pos, size = elements[CUES]
+    for id, cue, cue_size in iter_elements(buf, pos, pos + size):
+      if id != CUE_POINT: continue
+      time = None
+      track = False
+      for child, data, data_size in iter_elements(buf, cue, cue + cue_size):
+        if child == CUE_TIME:
+          time = read_uint(buf, data, data_size)
+        elif child == CUE_TRACK_POSITIONS:
+          for element, element_data, element_size in iter_elements(buf, data, data + data_size):
+            if element == CUE_TRACK and read_uint(buf, element_data, element_size) == track_number:
+              track = True
+      if track and time is not None:
+        timestamps.append(time)
+
+    total_frames = None
+    if TAGS in elements:
+      pos, size = elements[TAGS]
+      for id, tag, tag_size in iter_elements(buf, pos, pos + size):
+        if id != TAG: continue
+        tag_track = False
+        number_of_frames = None
+        for child, data, data_size in iter_elements(buf, tag, tag + tag_size):
+          if child == TARGETS:
+            for element, element_data, element_size in iter_elements(buf, data, data + data_size):
+              if element == TAG_TRACK_UID and read_uint(buf, element_data, element_size) == track_uid:
+                tag_track = True
+          elif child == SIMPLE_TAG:
+            name = value = None
+            for element, element_data, element_size in iter_elements(buf, data, data + data_size):
+              if element == TAG_NAME:
+                name = buf[element_data:element_data + element_size].decode("utf-8").rstrip("\0")
+              elif element == TAG_STRING:
+                value = buf[element_data:element_data + element_size].decode("utf-8").rstrip("\0")
+            if name == "NUMBER_OF_FRAMES":
+              number_of_frames = value
+        if tag_track and number_of_frames:
+          total_frames = number_of_frames
+          break
+  finally:
+    buf.close()
+
+  if not timestamps:
+    return None, "Unable to find cues for the video track"
+
+  timestamps = [t - timestamps[0] for t in timestamps]
+  frames = [round(timecode_scale / frame_duration * t) for t in timestamps]
+
+  return frames, int(total_frames) if total_frames else total_frames
+
+# the previous parser, reads every element but clusters with enzyme
+def get_mkv_keyframes_enzyme(src):
+  import enzyme
+
   mkv = enzyme.parsers.ebml.parse(
     open(src, "rb"),
     enzyme.parsers.ebml.get_matroska_specs(),
@@ -97,6 +244,128 @@ def get_mkv_keyframes_fast(src):
 
   return frames, int(total_frames) if total_frames else total_frames
 
+# walks the clusters and reads only the block headers of the video track
+# a block is a keyframe if its SimpleBlock has the keyframe flag or its BlockGroup has no ReferenceBlock
+# blocks come in decode order, their rank by timestamp is the frame number as in get_keyframes_ffprobe, so a keyframe
+# stored before the frames shown ahead of it (open GOP, B-pyramid) isn't placed early
+# frames of a laced block share its timestamp and keep their order
+def get_mkv_keyframes_clusters(src):
+  buf = open_mmap(src)
+  try:
+    start, end = find_segment(buf)
+    track_number = None
+    keyframes = []
+    timestamps = []
+
+    pos = start
+    while pos < end:
+      id, data = read_id(buf, pos)
+      size, data = read_size(buf, data)
+
+      if id == TRACKS:
+        track_number = find_video_track(buf, data, data + size)[0]
+
+      elif id == CLUSTER:
+        if track_number is None:
+          raise EBMLError("no video track before the first cluster")
+
+        cluster_end = end if size is None else min(data + size, end)
+        cluster_timecode = 0
+        pos = data
+        while pos < cluster_end:
+          child, child_data = read_id(buf, pos)
+          # an unknown-sized cluster ends at the next level 1 element
+          if size is None and child in top_level: break
+          child_size, child_data = read_size(buf, child_data)
+
+          if child == CLUSTER_TIMECODE:
+            cluster_timecode = read_uint(buf, child_data, child_size)
+
+          elif child == SIMPLE_BLOCK:
+            track, keyframe, count, timecode = read_block_header(buf, child_data)
+            if track == track_number:
+              if keyframe: keyframes.append(len(timestamps))
+              timestamps.extend([cluster_timecode + timecode] * count)
+
+          elif child == BLOCK_GROUP:
+            track = None
+            keyframe = True
+            group = child_data
+            while group < child_data + child_size:
+              element, element_data = read_id(buf, group)
+              element_size, element_data = read_size(buf, element_data)
+              if element == BLOCK:
+                track, _, count, timecode = read_block_header(buf, element_data)
+              elif element == REFERENCE_BLOCK:
+                keyframe = False
+              group = element_data + element_size
+
+            if track == track_number:
+              if keyframe: keyframes.append(len(timestamps))
+              timestamps.extend([cluster_timecode + timecode] * count)
+
+          pos = child_data + child_size
+        continue
+
+      if size is None:
+        raise EBMLError(f"unknown size for element {id:x}")
+      pos = data + size
+
+    if track_number is None:
+      raise EBMLError("no video track")
+
+    # without reordering the blocks already are in presentation order
+    if any(a > b for a, b in zip(timestamps, timestamps[1:])):
+      import numpy as np
+      order = np.argsort(timestamps, kind="stable")
+      rank = np.empty(len(order), dtype=np.int64)
+      rank[order] = np.arange(len(order))
+      keyframes = sorted(rank[keyframes].tolist())
+
+    return keyframes, len(timestamps)
+  finally:
+    buf.close()
+
+# reads the packet flags of the first video stream with ffprobe, nothing is decoded
+# packets come in decode order, their rank by timestamp is the frame number
+def get_keyframes_ffprobe(src):
+  cmd = [
+    "ffprobe", "-v", "error",
+    "-select_streams", "v:0",
+    "-show_entries", "packet=pts,dts,flags",
+    "-of", "csv=p=0", src
+  ]
+
+  pipe = subprocess.Popen(cmd,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL)
+
+  timestamps = []
+  keyframes = []
+  for line in pipe.stdout:
+    pts, dts, flags = line.decode("utf-8").strip().split(",")[:3]
+    # packets flagged to be discarded are never shown
+    if "D" in flags: continue
+    timestamp = pts if pts != "N/A" else dts
+    if timestamp == "N/A":
+      timestamp = timestamps[-1] + 1 if timestamps else 0
+    if "K" in flags:
+      keyframes.append(len(timestamps))
+    timestamps.append(int(timestamp))
+
+  # a partial packet list would pass for the whole file
+  if pipe.wait() != 0:
+    raise ValueError(f"ffprobe exited with {pipe.returncode}")
+  if not timestamps:
+    raise ValueError("no video packets")
+
+  import numpy as np
+  order = np.argsort(timestamps, kind="stable")
+  rank = np.empty(len(order), dtype=np.int64)
+  rank[order] = np.arange(len(order))
+
+  return sorted(rank[keyframes].tolist()), len(timestamps)
+
 def get_mkv_keyframes_slow(src):
   ff = [
     "ffmpeg", "-hide_banner",
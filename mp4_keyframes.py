@@ -0,0 +1,71 @@
+import struct
+from .ebml import open_mmap
+
+# Keyframes of MP4/MOV files from the sync sample table (stss) of the first video track.
+# Only the moov box is read, fragmented files keep their samples in moof boxes and aren't supported.
+
+class MP4Error(Exception):
+  pass
+
+# yields type, data start, data end of the boxes in [start, end)
+def iter_boxes(buf, start, end):
+  pos = start
+  while pos + 8 <= end:
+    size, type = struct.unpack_from(">I4s", buf, pos)
+    header = 8
+    if size == 1:
+      size = struct.unpack_from(">Q", buf, pos + 8)[0]
+      header = 16
+    elif size == 0:
+      size = end - pos
+    if size < header:
+      raise MP4Error(f"invalid box size at {pos}")
+    yield type, pos + header, min(pos + size, end)
+    pos += size
+
+def find_box(buf, start, end, *path):
+  for type, data, box_end in iter_boxes(buf, start, end):
+    if type == path[0]:
+      return (data, box_end) if len(path) == 1 else find_box(buf, data, box_end, *path[1:])
+  return None
+
+# returns list of keyframes, total_frames
+def get_mp4_keyframes(src):
+  buf = open_mmap(src)
+  try:
+    if not find_box(buf, 0, len(buf), b"ftyp"):
+      raise MP4Error("not an mp4 file")
+
+    moov = find_box(buf, 0, len(buf), b"moov")
+    if not moov:
+      raise MP4Error("no moov box")
+    if find_box(buf, *moov, b"mvex"):
+      raise MP4Error("fragmented mp4")
+
+    for type, trak, trak_end in iter_boxes(buf, *moov):
+      if type != b"trak": continue
+
+      hdlr = find_box(buf, trak, trak_end, b"mdia", b"hdlr")
+      # version and flags, pre_defined, then the handler type
+      if not hdlr or buf[hdlr[0] + 8:hdlr[0] + 12] != b"vide": continue
+
+      stbl = find_box(buf, trak, trak_end, b"mdia", b"minf", b"stbl")
+      if not stbl:
+        raise MP4Error("no sample table")
+
+      stsz = find_box(buf, *stbl, b"stsz") or find_box(buf, *stbl, b"stz2")
+      if not stsz:
+        raise MP4Error("no sample sizes")
+      total_frames = struct.unpack_from(">I", buf, stsz[0] + 8)[0]
+
+      stss = find_box(buf, *stbl, b"stss")
+      # without a sync sample table every sample is a sync sample
+      if not stss:
+        return list(range(total_frames)), total_frames
+
+      count = struct.unpack_from(">I", buf, stss[0] + 4)[0]
+      return [sample - 1 for sample in struct.unpack_from(f">{count}I", buf, stss[0] + 8)], total_frames
+
+    raise MP4Error("no video track")
+  finally:
+    buf.close()
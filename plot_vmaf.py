@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
-import subprocess, os, json, re
-import numpy as np
-import matplotlib.pyplot as plt
+import os, json
 import xml.etree.ElementTree as Xml
 
+try:
+  from .util import ffmpeg as run_ffmpeg
+  from .tracing import span
+except ImportError:
+  from util import ffmpeg as run_ffmpeg
+  from tracing import span
+
 def read_vmaf_xml(file):
   root = Xml.parse(file).getroot()
   frames = []
@@ -38,7 +43,7 @@ def read_vmaf_xml(file):
 
   return header, frames
 
-def create_log(source, encoded, frames, vmaf, extra_metrics=[], xml="plot.xml"):
+def create_log(source, encoded, frames, vmaf, extra_metrics=[], xml="plot.xml", tracer=None):
   extra = ":".join(extra_metrics)
   extra += ":" if len(extra) > 0 else ""
 
@@ -60,21 +65,8 @@ def create_log(source, encoded, frames, vmaf, extra_metrics=[], xml="plot.xml"):
     "-f", "null", "-"
   ])
 
-  pipe = subprocess.Popen(ffmpeg, 
-      stdout=subprocess.PIPE,
-      stderr=subprocess.STDOUT,
-      universal_newlines=True)
-  
-  while True:
-    line = pipe.stdout.readline().strip()
-
-    if len(line) == 0 and pipe.poll() is not None:
-      break
-
-    match = re.search(r"frame= *?([0-9]+)", line)
-    if match:
-      frames = int(match.group(1))
-      print(f"frame {frames}", end="\r")
+  with span(tracer, "vmaf", encoded=encoded):
+    run_ffmpeg(ffmpeg, lambda x: print(f"frame {x}", end="\r"), int(frames) if frames else None)
 
 def calculate(xml, output=None, png=False, svg=False, csv=False, psnr=False, ssim=False, ms_ssim=False):
   header, frames = read_vmaf_xml(xml)
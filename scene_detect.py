@@ -0,0 +1,25 @@
+# Scene detection backends used by split().
+# A backend is called as backend(src, cb, total_frames=None, cache=None, workdir=".", **options)
+# and returns a sorted list of keyframes starting at 0. cb gets the number of frames processed.
+# The detectors (and numpy with them) are only imported when a backend runs.
+
+def aom_backend(src, cb, total_frames=None, cache=None, workdir=".", chunks=1, proxy_height=None, monochrome=False, tracer=None):
+  from .aom_keyframes import get_aom_keyframes
+  return get_aom_keyframes(src, cb, chunks, total_frames, cache, workdir, proxy_height, monochrome, tracer)
+
+def luma_backend(src, cb, total_frames=None, cache=None, workdir=".", **options):
+  from .luma_keyframes import get_luma_keyframes
+  return get_luma_keyframes(src, cb, **options)
+
+backends = {
+  "aom": aom_backend,
+  "luma": luma_backend
+}
+
+def register_backend(name, backend):
+  backends[name] = backend
+
+def get_scene_keyframes(backend, src, cb, **kwargs):
+  if backend not in backends:
+    raise ValueError(f"unknown scene detection backend {backend}, available: {', '.join(backends)}")
+  return backends[backend](src, cb, **kwargs)
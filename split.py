@@ -1,9 +1,20 @@
-import os, shutil
-from .util import get_frames, ffmpeg, ffmpeg_pipe, vs_core
+import os, shutil, tempfile, asyncio, heapq
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+from .util import ffmpeg, ffmpeg_pipe, index_path, build_index, get_fps, get_codec, seek_args
+from .jobs import JobEngine
+from .frame_count import count_frames_batch
 from .mkv_keyframes import get_mkv_keyframes
-from .aom_keyframes import get_aom_keyframes
+from .scene_detect import get_scene_keyframes, backends
+from .cache import Cache, default_path as default_cache_path
+from .tracing import Tracer, span
+from .checkpoint import Checkpoint, phase_key
+from .cache import fingerprint
 
 # returns splits, total frames, segments
+# with return_keyframes the source keyframes come fourth, they can be passed on to verify_split so corrections don't
+# look them up again
 # splits are contained like so:
 # {
 #   "00000": {                # aom segment
@@ -19,19 +30,328 @@ from .aom_keyframes import get_aom_keyframes
 #     "length": 10
 #   }
 # }
-def split(video, path_split, min_frames=-1, max_frames=-1, cb=None):
-  if cb: cb("getting mkv keyframes")
-  mkv_keyframes, total_frames = get_mkv_keyframes(video)
-  if cb:
-    cb(f"total frames: {total_frames}")
-    cb(f"src keyframes: {len(mkv_keyframes)}")
-  
-  skip_keyframes = 0
-  aom_keyframes = get_aom_keyframes(video, lambda x: cb(f"getting aom keyframes: {x}/{total_frames}", cr=True))
-  if cb:
-    cb(f"aom keyframes: {len(aom_keyframes)}")
+# virtual segments also have "source" and "index", the source video and its shared ffms2 index
+# cache is a cache.Cache for the mkv keyframes and the aom first-pass stats
+# workdir holds the scratch files of this job
+# aom_proxy_height runs the aom first pass on a downscaled proxy
+# detector picks the scene detection backend from scene_detect.backends, detector_options are passed to it
+# tracer is a tracing.Tracer that gets a span for every stage
+# partitioner "optimal" evens out the segment lengths, with partitioner_options={"workers": n} it picks the cuts that
+# finish first on n encode workers, see optimal_keyframes
+# smart_cut starts every segment at its scene keyframe, copying all whole source GOPs, see smart_cut_segments
+# virtual writes no segment files, every split is a virtual segment read from the source through the shared ffms2
+# index, see write_vs_script
+# checkpoint is a checkpoint.Checkpoint, the keyframes, the partition and every finished segment are recorded in it
+# and skipped when split() is run again with the same arguments
+def split(video, path_split, min_frames=-1, max_frames=-1, cb=None, aom_chunks=1, cache=None, workdir=".", aom_proxy_height=None,
+  detector="aom", detector_options=None, tracer=None, partitioner="greedy", partitioner_options=None, smart_cut=False,
+  virtual=False, checkpoint=None, return_keyframes=False):
+  if checkpoint:
+    keyframes_key = phase_key(fingerprint(video), detector, aom_chunks, aom_proxy_height, detector_options)
+    partition_key = phase_key(keyframes_key, min_frames, max_frames, partitioner, partitioner_options, smart_cut or virtual)
+    mux_key = phase_key(partition_key, smart_cut, os.path.abspath(path_split))
+
+  keyframes = checkpoint.get("keyframes", keyframes_key) if checkpoint else None
+  if keyframes:
+    if cb: cb("keyframes from checkpoint")
+    mkv_keyframes, total_frames, aom_keyframes = keyframes
+  else:
+    if cb: cb("getting mkv keyframes")
+    with span(tracer, "mkv keyframes"):
+      mkv_keyframes, total_frames = get_mkv_keyframes(video, cache)
+    if cb:
+      cb(f"total frames: {total_frames}")
+      cb(f"src keyframes: {len(mkv_keyframes)}")
+
+    options = {"chunks": aom_chunks, "proxy_height": aom_proxy_height, "tracer": tracer} if detector == "aom" else {}
+    options.update(detector_options or {})
+    with span(tracer, "scene detection", detector=detector):
+      aom_keyframes = get_scene_keyframes(detector, video,
+        lambda x: cb(f"getting {detector} keyframes: {x}/{total_frames}", cr=True),
+        total_frames=total_frames, cache=cache, workdir=workdir, **options)
+    if cb:
+      cb(f"{detector} keyframes: {len(aom_keyframes)}")
+    if checkpoint:
+      checkpoint.put("keyframes", keyframes_key, [mkv_keyframes, total_frames, aom_keyframes])
+
+  partitioned = checkpoint.get("partition", partition_key) if checkpoint else None
+  if partitioned:
+    frames, splits, segments, reencode = partitioned
+  else:
+    with span(tracer, "partitioning"):
+      frames, splits, segments, reencode = partition(aom_keyframes, mkv_keyframes, total_frames, min_frames, max_frames, cb,
+        partitioner, partitioner_options, smart_cut or virtual)
+    if checkpoint:
+      checkpoint.put("partition", partition_key, [frames, splits, segments, reencode])
+
+  if virtual:
+    with span(tracer, "index"):
+      index = build_index(video)
+    for segment in segments.values():
+      segment["source"] = os.path.abspath(video)
+      segment["index"] = index
+    return (splits, total_frames, segments, mkv_keyframes)[:4 if return_keyframes else 3]
+
+  os.makedirs(path_split, exist_ok=True)
+  paths = [os.path.join(path_split, segment) for segment in segments]
+  if checkpoint:
+    checkpoint.begin("mux", mux_key)
+    # corrected segments are recorded by verify_split
+    if all(checkpoint.has_file("mux", path) or checkpoint.has_file("verify", path) for path in paths):
+      if cb: cb("segments from checkpoint")
+      return (splits, total_frames, segments, mkv_keyframes)[:4 if return_keyframes else 3]
+
+  code = 0
+  with span(tracer, "segment mux", reencode=reencode):
+    if reencode:
+      # finished ranges are recorded and skipped by the checkpoint
+      reencode_segments(video, path_split, frames, total_frames, lambda x: cb(f"splitting {x}/{total_frames}", cr=True) if cb else None,
+        checkpoint=checkpoint)
+    elif smart_cut:
+      smart_cut_segments(video, path_split, frames, mkv_keyframes, total_frames, cb, workdir)
+    else:
+      frames = [str(f) for f in frames]
+
+      cmd = [
+        "ffmpeg", "-y",
+        "-hide_banner",
+        "-i", video,
+        "-map", "0:v:0",
+        "-avoid_negative_ts", "1",
+        "-vsync", "0",
+        "-c:v", "copy",
+        "-f", "segment",
+        "-segment_frames", ",".join(frames[1:]),
+        os.path.join(path_split, "%05d.mkv")
+      ]
+
+      code = ffmpeg(cmd, lambda x: cb(f"splitting {x}/{total_frames}", cr=True), total_frames)
+
+  # segments that weren't written are left to verify_split
+  if checkpoint and code == 0:
+    checkpoint.add_files("mux", [path for path in paths if os.path.exists(path)])
+
+  return (splits, total_frames, segments, mkv_keyframes)[:4 if return_keyframes else 3]
+
+# losslessly re-encodes the source into segments starting at frames (sorted, the first one 0)
+# the segments are grouped into workers contiguous ranges of about the same number of frames, every range is
+# one ffmpeg that seeks to its first frame and writes its segments, keyframes are forced at the segment starts
+# by timestamp. seeking assumes a constant frame rate
+# with a checkpoint a range whose segments were all finished before is skipped, finished ranges are recorded under "mux"
+def reencode_segments(video, path_split, frames, total_frames, cb=None, workers=None, checkpoint=None):
+  cpus = os.cpu_count() or 1
+  workers = max(1, min(workers or cpus // 4, len(frames)))
+  threads = max(1, cpus // workers)
+  fps = get_fps(video)
+
+  # the range a segment goes to by the middle of the segment
+  bounds = frames + [total_frames]
+  groups = [[] for _ in range(workers)]
+  for n in range(len(frames)):
+    middle = (bounds[n] + bounds[n + 1]) / 2
+    groups[min(int(middle * workers / total_frames), workers - 1)].append(n)
+  groups = [group for group in groups if group]
+
+  progress = [0] * len(groups)
+  def on_progress(i, x):
+    progress[i] = x
+    if cb: cb(sum(progress))
+
+  def command(group):
+    start = frames[group[0]]
+    length = bounds[group[-1] + 1] - start
+    # after seeking the first frame comes out half a frame after 0, without seeking at 0
+    # a quarter frame early the forced time is before the segment start either way, but after the frame before it
+    times = [f"{(frames[n] - start - 0.25) / fps:.6f}" for n in group[1:]]
+    cmd = [
+      "ffmpeg", "-y",
+      "-hide_banner",
+      *seek_args(start, fps),
+      "-i", video,
+      "-map", "0:v:0",
+      "-avoid_negative_ts", "1",
+      "-vsync", "0",
+      "-frames:v", str(length),
+      "-c:v", "libx264",
+      "-x264-params", "scenecut=-1",
+      "-preset", "veryfast",
+      "-threads", str(threads),
+      "-crf", "0"
+    ]
+    cmd.extend(["-f", "segment", "-segment_start_number", str(group[0])])
+    if times:
+      cmd.extend([
+        "-force_key_frames", ",".join(times),
+        "-segment_frames", ",".join(str(frames[n] - start) for n in group[1:])
+      ])
+    cmd.append(os.path.join(path_split, "%05d.mkv"))
+    return cmd, length
+
+  engine = JobEngine({"encode": workers})
+
+  async def run(i, group):
+    cmd, length = command(group)
+    paths = [os.path.join(path_split, f"{n:05d}.mkv") for n in group]
+    if checkpoint and all(checkpoint.has_file("mux", path) or checkpoint.has_file("verify", path) for path in paths):
+      on_progress(i, length)
+      return
+    code = await engine.run(cmd, "encode", lambda x: on_progress(i, x), length)
+    if checkpoint and code == 0:
+      checkpoint.add_files("mux", [path for path in paths if os.path.exists(path)])
+
+  asyncio.run(engine.gather(run(i, group) for i, group in enumerate(groups)))
+
+# writes a segment for every cut in cuts (sorted, the first one 0) that starts exactly on the cut
+# the source is first stream copied into pieces at the source keyframes around the cuts, a segment is
+# then the concatenation of the whole pieces it covers and lossless re-encodes of the frames it needs from
+# the pieces its cuts fall into, so only the source GOPs containing a cut are re-encoded.
+# h264 parts carry their headers in-band so copied and re-encoded parts can be concatenated,
+# for other codecs a segment that needs any re-encoding is re-encoded whole
+# lossless x264 writes High 4:4:4 Predictive parameter sets, so such a segment switches profile in-band in the middle
+# of a stream of the source profile, which not every decoder handles
+# raises ValueError when the stream copy fails, a segment whose parts fail is left out for verify_split to correct
+# returns the number of frames that were re-encoded
+def smart_cut_segments(video, path_split, cuts, mkv_keyframes, total_frames, cb=None, workdir=".", workers=None):
+  keyframes = sorted(set(mkv_keyframes) | {0})
+  h264 = get_codec(video) == "h264"
+
+  # piece boundaries: every cut on a source keyframe, and the keyframes around every other cut
+  boundaries = {0}
+  for cut in cuts[1:]:
+    i = bisect_right(keyframes, cut)
+    if keyframes[i - 1] == cut:
+      boundaries.add(cut)
+    else:
+      boundaries.add(keyframes[i - 1])
+      boundaries.add(keyframes[i] if i < len(keyframes) else total_frames)
+  boundaries.discard(total_frames)
+  boundaries = sorted(boundaries)
+  ends = boundaries[1:] + [total_frames]
+
+  tmp = tempfile.mkdtemp(prefix="smartcut", dir=workdir)
+  piece = lambda j: os.path.join(tmp, f"piece_{j:05d}.mkv")
 
-  if min_frames != -1:
+  cmd = [
+    "ffmpeg", "-y",
+    "-hide_banner",
+    "-i", video,
+    "-map", "0:v:0",
+    "-avoid_negative_ts", "1",
+    "-vsync", "0",
+    "-c:v", "copy"
+  ]
+  if h264:
+    cmd.extend(["-bsf:v", "h264_mp4toannexb"])
+  cmd.extend(["-f", "segment"])
+  if len(boundaries) > 1:
+    cmd.extend(["-segment_frames", ",".join(str(b) for b in boundaries[1:])])
+  cmd.append(os.path.join(tmp, "piece_%05d.mkv"))
+
+  if cb: cb(f"copying {len(boundaries)} pieces")
+  code = ffmpeg(cmd, lambda x: cb(f"copying {x}/{total_frames}", cr=True) if cb else None, total_frames)
+  if code != 0:
+    shutil.rmtree(tmp, ignore_errors=True)
+    raise ValueError(f"ffmpeg exited with {code} copying the pieces")
+
+  # parts of every segment as (piece numbers, first frame within them, frames), frames is None for whole pieces
+  cut_ends = cuts[1:] + [total_frames]
+  plans = []
+  reencoded = 0
+  for n, (start, end) in enumerate(zip(cuts, cut_ends)):
+    parts = []
+    j = bisect_right(boundaries, start) - 1
+    while j < len(boundaries) and boundaries[j] < end:
+      first = max(start, boundaries[j])
+      last = min(end, ends[j])
+      if first == boundaries[j] and last == ends[j]:
+        parts.append(([j], 0, None))
+      else:
+        parts.append(([j], first - boundaries[j], last - first))
+      j += 1
+
+    if not h264 and any(count is not None for _, _, count in parts):
+      pieces = [j for part in parts for j in part[0]]
+      parts = [(pieces, start - boundaries[pieces[0]], end - start)]
+
+    reencoded += sum(count for _, _, count in parts if count is not None)
+    plans.append(parts)
+
+  if cb: cb(f"re-encoding {reencoded}/{total_frames} frames")
+
+  engine = JobEngine({"encode": workers or max(1, (os.cpu_count() or 1) // 2)})
+
+  # a list file for the concat demuxer
+  def concat_list(name, files):
+    path = os.path.join(tmp, name)
+    with open(path, "w") as f:
+      f.writelines(f"file '{os.path.abspath(file)}'\n" for file in files)
+    return ["-f", "concat", "-safe", "0", "-i", path]
+
+  async def encode(n, k, part):
+    pieces, first, count = part
+    output = os.path.join(tmp, f"part_{n:05d}_{k}.mkv")
+    source = ["-i", piece(pieces[0])] if len(pieces) == 1 else concat_list(f"pieces_{n:05d}.txt", [piece(j) for j in pieces])
+    cmd = [
+      "ffmpeg", "-y",
+      "-hide_banner",
+      *source,
+      "-map", "0:v:0",
+      "-vsync", "0",
+      "-vf", f"select=gte(n\\,{first}),setpts=PTS-STARTPTS",
+      "-frames:v", str(count),
+      "-c:v", "libx264",
+      "-preset", "veryfast",
+      "-crf", "0",
+      "-x264-params", "repeat-headers=1",
+      output
+    ]
+    code = await engine.run(cmd, "encode")
+    return output if code == 0 else None
+
+  async def whole(part):
+    return piece(part[0][0]) if os.path.exists(piece(part[0][0])) else None
+
+  async def write_segment(n, parts):
+    files = await asyncio.gather(*(encode(n, k, part) if part[2] is not None else whole(part) for k, part in enumerate(parts)))
+
+    path = os.path.join(path_split, f"{n:05d}.mkv")
+    # a segment left from an earlier run would pass verify_split
+    if os.path.exists(path):
+      os.unlink(path)
+    if None in files:
+      if cb: cb(f"smart cut of {n:05d}.mkv failed, left to verify_split")
+      return
+
+    # a whole piece only ever belongs to one segment
+    if len(files) == 1:
+      os.replace(files[0], path)
+    else:
+      cmd = ["ffmpeg", "-y", "-hide_banner", *concat_list(f"segment_{n:05d}.txt", files), "-map", "0:v:0", "-c", "copy", path]
+      if await engine.run(cmd, "decode") != 0 and os.path.exists(path):
+        os.unlink(path)
+    if cb: cb(f"smart cut {n + 1}/{len(plans)}", cr=True)
+
+  try:
+    asyncio.run(engine.gather(write_segment(n, parts) for n, parts in enumerate(plans)))
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  return reencoded
+
+# merges scenes shorter than min_frames, splits scenes longer than max_frames and places the segments
+# on the source keyframes, or on the scene keyframes with reencode set when the source keyframes are unusable
+# partitioner "optimal" picks the cuts with optimal_keyframes instead, partitioner_options are passed to it
+# with exact every split gets its own segment starting at the scene keyframe, for smart cuts and virtual segments
+# returns segment start frames, splits, segments, reencode
+def partition(aom_keyframes, mkv_keyframes, total_frames, min_frames=-1, max_frames=-1, cb=None, partitioner="greedy",
+  partitioner_options=None, exact=False):
+  if partitioner not in partitioners:
+    raise ValueError(f"unknown partitioner {partitioner}, available: {', '.join(partitioners)}")
+
+  skip_keyframes = 0
+  if partitioner == "optimal":
+    aom_keyframes = optimal_keyframes(aom_keyframes, mkv_keyframes, total_frames, min_frames, max_frames, **(partitioner_options or {}))
+  elif min_frames != -1:
     aom_keyframes.append(total_frames)
     final_scenes = []
     aom_scenes = [(aom_keyframes[i], aom_keyframes[i + 1] - aom_keyframes[i]) for i in range(len(aom_keyframes) - 1)]
@@ -62,14 +382,14 @@ def split(video, path_split, min_frames=-1, max_frames=-1, cb=None):
   if total_frames not in aom_keyframes:
     aom_keyframes.append(total_frames)
 
-  if max_frames != -1:
+  if max_frames != -1 and partitioner != "optimal":
     aom_kf = apply_max_dist(aom_keyframes, min_frames, max_frames, mkv_keyframes)
   else:
     aom_kf = aom_keyframes
 
   frames, splits, segments = partition_with_mkv(aom_kf, mkv_keyframes, total_frames)
   reencode = False
-  if len(frames) < len(aom_keyframes) / 2:
+  if exact or len(frames) < len(aom_keyframes) / 2:
     splits = {}
     frames = []
     segments = {}
@@ -77,7 +397,7 @@ def split(video, path_split, min_frames=-1, max_frames=-1, cb=None):
     if max_frames != -1:
       aom_keyframes = apply_max_dist(aom_keyframes, min_frames, max_frames)
 
-    if cb:
+    if cb and not exact:
       cb("keyframes unreliable, re-encoding")
 
     for i in range(len(aom_kf) - 1):
@@ -97,44 +417,134 @@ def split(video, path_split, min_frames=-1, max_frames=-1, cb=None):
         "length": length
       }
 
-    reencode = True
-
-  frames = [str(f) for f in frames]
-
-  cmd = [
-    "ffmpeg", "-y",
-    "-hide_banner",
-    "-i", video,
-    "-map", "0:v:0",
-    "-avoid_negative_ts", "1",
-    "-vsync", "0"
-  ]
-
-  if reencode: 
-    cmd.extend([
-      "-c:v", "libx264",
-      "-x264-params", "scenecut=-1",
-      "-preset", "veryfast",
-      "-threads", "16",
-      "-crf", "0",
-      "-force_key_frames", "expr:" + "+".join([f"eq(n,{int(f)})" for f in frames])
-    ])
+    reencode = not exact
+
+  return frames, splits, segments, reencode
+
+# the keyframe in keyframes (sorted) nearest to target and less than tolerance away, the earlier one on a tie
+def nearest_keyframe(keyframes, target, tolerance):
+  lo = bisect_right(keyframes, target - tolerance)
+  hi = bisect_left(keyframes, target + tolerance)
+  i = bisect_left(keyframes, target, lo, hi)
+  below = keyframes[i - 1] if i > lo else None
+  above = keyframes[i] if i < hi else None
+  if below is None:
+    return above
+  if above is None or target - below <= above - target:
+    return below
+  return above
+
+partitioners = ["greedy", "optimal"]
+
+# time until the last of workers is done when every job goes to the worker free first, longest job first
+def makespan(lengths, workers):
+  busy = [0] * workers
+  for length in sorted(lengths, reverse=True):
+    heapq.heappush(busy, heapq.heappop(busy) + length)
+  return max(busy)
+
+# picks the cuts by dynamic programming, see keyframes_by_cost
+# without workers that's one pass with target between min_frames and max_frames (or the mean scene length), which
+# evens out the lengths but doesn't shorten the makespan
+# with workers it tries targets that give every worker the same number of segments too, and returns whichever of
+# those and the greedy partition finishes first on workers, see makespan. of the ones within tolerance of the
+# shortest makespan the one with the most cuts on scene changes wins
+# returns the cuts starting with 0 and ending with total_frames
+def optimal_keyframes(aom_keyframes, mkv_keyframes, total_frames, min_frames=-1, max_frames=-1, target=None,
+  scene_penalty=1.0, source_bonus=0.1, workers=None, tries=6, tolerance=0.002):
+  if not target:
+    if min_frames != -1 and max_frames != -1:
+      target = (min_frames + max_frames) / 2
+    elif max_frames != -1:
+      target = max_frames * 0.75
+    elif min_frames != -1:
+      target = min_frames * 2
+    else:
+      target = total_frames / max(len(aom_keyframes), 1)
+  cost = (aom_keyframes, mkv_keyframes, total_frames, min_frames, max_frames)
+  cuts = keyframes_by_cost(*cost, target, scene_penalty, source_bonus)
+  if not workers:
+    return cuts
+
+  candidates = [cuts]
+  shortest = max(min_frames, 1)
+  longest = max_frames if max_frames != -1 else total_frames
+  first = max(1, -(-total_frames // (workers * longest)))
+  for k in range(first, first + tries):
+    length = total_frames / (k * workers)
+    if length < shortest: break
+    candidates.append(keyframes_by_cost(*cost, length, scene_penalty, source_bonus))
+
+  _, greedy, _, _ = partition(list(aom_keyframes), mkv_keyframes, total_frames, min_frames, max_frames)
+  candidates.append([0, *accumulate(split["frames"] for split in greedy.values())])
+
+  # the greedy partition can overshoot the limits, the dynamic programming ones only when nothing fits
+  lengths = [[b - a for a, b in zip(cuts, cuts[1:])] for cuts in candidates]
+  within = [i for i, l in enumerate(lengths) if min(l) >= shortest and max(l) <= longest] or [0]
+  spans = {i: makespan(lengths[i], workers) for i in within}
+  limit = min(spans.values()) * (1 + tolerance)
+  scene = set(aom_keyframes)
+  return max((candidates[i] for i in within if spans[i] <= limit), key=lambda cuts: len(scene.intersection(cuts)))
+
+# picks the cuts by dynamic programming out of the scene keyframes, the source keyframes and a grid
+# every segment costs its squared distance from target relative to target, a cut where there's no scene
+# change costs scene_penalty and a cut on a source keyframe saves source_bonus
+# lengths outside min_frames/max_frames cost more than any partition within them, so they're only used when
+# nothing else fits
+# returns the cuts starting with 0 and ending with total_frames
+def keyframes_by_cost(aom_keyframes, mkv_keyframes, total_frames, min_frames, max_frames, target, scene_penalty=1.0,
+  source_bonus=0.1):
+  target = max(target, 1)
+
+  # at least two grid steps fit within [min_frames, max_frames], so once every frame can be reached so can every
+  # grid point after it. near the start and the end only some frames are sums of lengths within the limits,
+  # every frame is a candidate there
+  edge = 0
+  if max_frames != -1:
+    width = max_frames - max(min_frames, 0) + 1
+    grid = max(1, min(int(target // 2), width // 2))
+    window = max_frames + grid
+    edge = max_frames * (-(-max(min_frames, 0) // width) + 1)
   else:
-    cmd.extend([
-      "-c:v", "copy"
-    ])
-
-  cmd.extend([
-    "-f", "segment",
-    "-segment_frames", ",".join(frames[1:]),
-    os.path.join(path_split, "%05d.mkv")
-  ])
-
-  os.makedirs(path_split, exist_ok=True)
-  ffmpeg(cmd, lambda x: cb(f"splitting {x}/{total_frames}", cr=True))
-
-  return splits, total_frames, segments
-
+    grid = max(1, int(target // 2))
+    window = int(target * 4)
+
+  scene = set(aom_keyframes)
+  source = set(mkv_keyframes)
+  candidates = sorted({0, total_frames, *range(0, total_frames, grid),
+    *range(1, min(edge, total_frames)), *range(max(total_frames - edge, 1), total_frames),
+    *(f for f in aom_keyframes if 0 < f < total_frames), *(f for f in mkv_keyframes if 0 < f < total_frames)})
+
+  best = [0.0] * len(candidates)
+  previous = [0] * len(candidates)
+  for j in range(1, len(candidates)):
+    frame = candidates[j]
+    cut = 0.0
+    if frame != total_frames:
+      cut = (0.0 if frame in scene else scene_penalty) - (source_bonus if frame in source else 0.0)
+
+    lo = min(bisect_left(candidates, frame - window), j - 1)
+    best_cost = None
+    for i in range(lo, j):
+      length = frame - candidates[i]
+      cost = best[i] + ((length - target) / target) ** 2
+      if min_frames != -1 and length < min_frames:
+        cost += 1e9 * (min_frames - length)
+      if max_frames != -1 and length > max_frames:
+        cost += 1e9 * (length - max_frames)
+      if best_cost is None or cost < best_cost:
+        best_cost = cost
+        previous[j] = i
+    best[j] = best_cost + cut
+
+  cuts = [total_frames]
+  j = len(candidates) - 1
+  while j:
+    j = previous[j]
+    cuts.append(candidates[j])
+  return cuts[::-1]
+
+# mkv_keyframes are sorted
 def apply_max_dist(aom_keyframes, min_dist, max_dist, mkv_keyframes=[], tolerance=5):
   final_kf = [aom_keyframes[0]]
   for i in range(len(aom_keyframes) - 1):
@@ -144,36 +554,31 @@ def apply_max_dist(aom_keyframes, min_dist, max_dist, mkv_keyframes=[], toleranc
 
     while length > max_dist:
       if length - max_dist >= max_dist:
-        candidate_kfs = [(f2, abs(frame + max_dist - f2)) for f2 in mkv_keyframes if abs(frame + max_dist - f2) < tolerance]
-        if len(candidate_kfs) > 0:
-          frame = sorted(candidate_kfs, key=lambda x: x[1])[0][0]
-        else:
-          frame += max_dist
-
-        length = next_frame - frame
-        final_kf.append(frame)
+        step = max_dist
       elif int(length / 2) > min_dist:
-        candidate_kfs = [(f2, abs(frame + int(length / 2) - f2)) for f2 in mkv_keyframes if abs(frame + int(length / 2) - f2) < tolerance]
-        if len(candidate_kfs) > 0:
-          frame = sorted(candidate_kfs, key=lambda x: x[1])[0][0]
-        else:
-          frame += int(length / 2)
-        
-        length = next_frame - frame
-        final_kf.append(frame)
+        step = int(length / 2)
       else: break
 
+      # with a step shorter than tolerance the nearest source keyframe can be behind frame
+      candidate = nearest_keyframe(mkv_keyframes, frame + step, tolerance)
+      frame = candidate if candidate is not None and candidate > frame else frame + step
+
+      length = next_frame - frame
+      final_kf.append(frame)
+
     final_kf.append(next_frame)
 
   return final_kf
 
+# mkv_keyframes are sorted
 def partition_with_mkv(aom_keyframes, mkv_keyframes, total_frames):
-  aom_keyframes = aom_keyframes
   mkv_keyframes = mkv_keyframes + [total_frames]
+  mkv_set = set(mkv_keyframes)
 
   splits = {}
   last_end = 0
   frames = []
+  frames_set = set()
   segments = {}
 
   for i in range(len(aom_keyframes) - 1):
@@ -182,21 +587,20 @@ def partition_with_mkv(aom_keyframes, mkv_keyframes, total_frames):
     segment_n = len(frames)
     start = 0
     length = next_frame - frame
-    if frame in mkv_keyframes:
+    if frame in mkv_set:
       frames.append(frame)
+      frames_set.add(frame)
     else:
-      largest = 0
-      for j in mkv_keyframes:
-        if j < frame:
-          largest = j
-        else:
-          break
+      # the last source keyframe before frame
+      j = bisect_left(mkv_keyframes, frame)
+      largest = mkv_keyframes[j - 1] if j > 0 else 0
       start = frame - largest
-      if largest in frames or largest < last_end:
+      if largest in frames_set or largest < last_end:
         segment_n -= 1
         start = frame - frames[len(frames)-1]
       else:
         frames.append(largest)
+        frames_set.add(largest)
     
     splits[f"{len(splits):05d}"] = ({"segment": f"{segment_n:05d}.mkv", "start": start, "frames": length, "filesize": 0})
     last_end = frame + length
@@ -209,18 +613,53 @@ def partition_with_mkv(aom_keyframes, mkv_keyframes, total_frames):
 
   return frames, splits, segments
 
-def write_vs_script(src):
+# splits several sources at once, jobs is a list of (video, path_split)
+# every job gets its own temporary workdir, returns the results of split() in the same order
+# a tracer is shared by the jobs, its spans carry their thread. a checkpoint holds the phases of one job,
+# run split() with a checkpoint per source instead
+def split_batch(jobs, workers=None, cb=None, **kwargs):
+  if kwargs.get("checkpoint"):
+    raise ValueError("split_batch can't share a checkpoint between jobs, call split() with one checkpoint per source")
+  if not workers:
+    # the aom first pass already uses 8 threads
+    workers = max(1, (os.cpu_count() or 1) // 8)
+
+  def run(job):
+    video, path_split = job
+    name = os.path.basename(video)
+    with tempfile.TemporaryDirectory() as workdir:
+      return split(video, path_split,
+        cb=lambda x, cr=False: cb(f"{name}: {x}", cr=cr) if cb else None,
+        workdir=workdir, **kwargs)
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    return list(executor.map(run, jobs))
+
+# with start and length only that range of src is output
+def write_vs_script(src, path="vs.vpy", start=None, length=None):
+  cachefile = index_path(src).replace("\\","\\\\")
   src = src.replace("\\","\\\\")
+  trim = f".std.Trim({start}, {start + length - 1})" if start is not None else ""
   script = f"""from vapoursynth import core
-core.ffms2.Source("{src}").set_output()"""
+core.ffms2.Source("{src}", cachefile="{cachefile}"){trim}.set_output()"""
 
-  open("vs.vpy", "w+").write(script)
+  open(path, "w+").write(script)
 
-def correct_split(path_in, path_out, start, length, cb=None):
+# script that outputs a virtual segment, for encoders reading from vspipe
+def write_segment_script(segment, path):
+  write_vs_script(segment["source"], path, segment["start"], segment["length"])
+
+# commands that re-encode length frames from start of path_in to path_out
+# returns the vspipe and ffmpeg commands to pipe into each other, or None and a single ffmpeg command
+# without vapoursynth ffmpeg seeks to the last of the source keyframes before start and drops the frames up to
+# start, keyframes are looked up when not given. seeking assumes a constant frame rate
+def correct_split_cmds(path_in, path_out, start, length, workdir=".", keyframes=None):
   if shutil.which("vspipe"):
-    write_vs_script(path_in)
+    # named after the output so corrections can run at the same time, the caller removes it when done
+    script = os.path.join(workdir, f"{os.path.splitext(os.path.basename(path_out))[0]}.vpy")
+    write_vs_script(path_in, script)
     vspipe_cmd = [
-      "vspipe", "vs.vpy",
+      "vspipe", script,
       "-s", str(start),
       "-e", str(start + length - 1),
       "-y", "-"
@@ -232,53 +671,132 @@ def correct_split(path_in, path_out, start, length, cb=None):
       "-crf", "0",
       "-y", path_out
     ]
-    ffmpeg_pipe(vspipe_cmd, ffmpeg_cmd, lambda x: cb(f"correcting split {x}/{length}", cr=True))
-  else:
-    cmd = [
-      "ffmpeg", "-hide_banner",
-      "-i", path_in,
-      "-map", "0:v:0",
-      "-c:v", "libx264",
-      "-crf", "0",
-      "-vsync", "0",
-      "-force_key_frames", f"expr:eq(n,{start})",
-      "-x264-params", "scenecut=0",
-      "-vf", f"select=gte(n\\,{start})",
-      "-frames:v", str(length),
-      "-y", path_out
-    ]
-    ffmpeg(cmd, lambda x: cb(f"correcting split {x}/{length}", cr=True))
+    return vspipe_cmd, ffmpeg_cmd
+
+  if keyframes is None:
+    keyframes = get_mkv_keyframes(path_in)[0]
+  i = bisect_right(keyframes, start)
+  keyframe = keyframes[i - 1] if i > 0 else 0
+
+  cmd = [
+    "ffmpeg", "-hide_banner",
+    *seek_args(keyframe, get_fps(path_in)),
+    "-i", path_in,
+    "-map", "0:v:0",
+    "-c:v", "libx264",
+    "-crf", "0",
+    "-vsync", "0",
+    "-x264-params", "scenecut=0"
+  ]
+  if start > keyframe:
+    cmd.extend(["-vf", f"select=gte(n\\,{start - keyframe})"])
+  cmd.extend([
+    "-frames:v", str(length),
+    "-y", path_out
+  ])
+  return None, cmd
+
+def correct_split(path_in, path_out, start, length, cb=None, workdir=".", keyframes=None):
+  vspipe_cmd, ffmpeg_cmd = correct_split_cmds(path_in, path_out, start, length, workdir, keyframes)
+  progress = lambda x: cb(f"correcting split {x}/{length}", cr=True) if cb else None
+  if not vspipe_cmd:
+    return ffmpeg(ffmpeg_cmd, progress, length)
+  try:
+    return ffmpeg_pipe(vspipe_cmd, ffmpeg_cmd, progress, length)
+  finally:
+    # the script written by correct_split_cmds
+    os.remove(vspipe_cmd[1])
+
+# correct_split as a coroutine on a jobs.JobEngine
+async def correct_split_async(engine, path_in, path_out, start, length, cb=None, workdir=".", keyframes=None):
+  vspipe_cmd, ffmpeg_cmd = correct_split_cmds(path_in, path_out, start, length, workdir, keyframes)
+  if not vspipe_cmd:
+    return await engine.run(ffmpeg_cmd, "encode", cb, length)
+  try:
+    return await engine.pipe(vspipe_cmd, ffmpeg_cmd, ("decode", "encode"), cb, length)
+  finally:
+    os.remove(vspipe_cmd[1])
 
 # input the source and segments produced by split()
-def verify_split(path_in, path_split, segments, cb=None):
+# the frames of all segments are counted in parallel on workers processes first,
+# then the bad segments are corrected, up to workers at once
+# keyframes are the source keyframes returned by split(return_keyframes=True), they are only looked up (through cache)
+# if they aren't given and a correction needs them
+# with a checkpoint.Checkpoint segments verified or corrected before aren't counted again
+def verify_split(path_in, path_split, segments, cb=None, workdir=".", workers=None, tracer=None, keyframes=None, cache=None,
+  checkpoint=None):
+  # virtual segments are read straight from the source
+  if any("source" in segment for segment in segments.values()):
+    if cb: cb("virtual segments, nothing to verify")
+    return
+
+  paths = {segment: os.path.join(path_split, segment) for segment in segments}
+  verified = set()
+  if checkpoint:
+    checkpoint.begin("verify", phase_key(fingerprint(path_in), segments, os.path.abspath(path_split)))
+    verified = {segment for segment in segments if checkpoint.has_file("verify", paths[segment])}
+    if verified and cb: cb(f"{len(verified)} segments verified before")
+
+  # a segment can be missing after an interrupted correction
+  unverified = [paths[segment] for segment in segments if segment not in verified and os.path.exists(paths[segment])]
+  if cb: cb("counting segment frames")
+  with span(tracer, "verification", segments=len(unverified)):
+    counts = count_frames_batch(unverified, workers)
+  for segment in verified:
+    counts[paths[segment]] = segments[segment]["length"]
+
+  bad = []
   total_frames = 0
   for i, segment in enumerate(segments, start=1):
-    path_segment = os.path.join(path_split, segment)
-    segment_n = str(os.path.splitext(segment)[0])
-    num_frames = get_frames(path_segment)
+    path_segment = paths[segment]
+    num_frames = counts.get(path_segment)
 
     if cb: cb(f"verifying splits: {i}/{len(segments)}", cr=True)
 
     if total_frames != segments[segment]["start"]:
-      cb(f"misalignment at {segment} expected: {segments[segment]['start']}, got: {total_frames}")
+      if cb: cb(f"misalignment at {segment} expected: {segments[segment]['start']}, got: {total_frames}")
+    elif num_frames is None:
+      if cb: cb(f"missing {segment}")
     elif num_frames != segments[segment]["length"]:
-      cb(f"bad framecount {segment} expected: {segments[segment]['length']}, got: {num_frames}")
-    elif not vs_core:
-      num_frames_slow = get_frames(path_segment, False)
-      if num_frames != num_frames_slow:
-        cb(f"bad framecount {segment} expected: {num_frames}, got: {num_frames_slow}")
-      else:
-        total_frames += num_frames
-        continue
+      if cb: cb(f"bad framecount {segment} expected: {segments[segment]['length']}, got: {num_frames}")
     else:
       total_frames += num_frames
       continue
 
-    os.makedirs(os.path.join(path_split, "old"), exist_ok=True)
-    os.rename(path_segment, os.path.join(path_split, "old", segment))
-    correct_split(path_in, path_segment, segments[segment]["start"], segments[segment]["length"], lambda x, cr=False: cb(x, cr=cr))
-    
-    total_frames += num_frames
+    bad.append(segment)
+    # the corrected segment will have the expected length
+    total_frames = segments[segment]["start"] + segments[segment]["length"]
+
+  if checkpoint:
+    checkpoint.add_files("verify", [paths[segment] for segment in segments if segment not in bad and segment not in verified])
+
+  if not bad:
+    return
+
+  if shutil.which("vspipe"):
+    # the scripts share one ffms2 index, build it once instead of in every vspipe
+    build_index(path_in)
+  elif keyframes is None:
+    keyframes = get_mkv_keyframes(path_in, cache)[0]
+
+  os.makedirs(os.path.join(path_split, "old"), exist_ok=True)
+  for segment in bad:
+    if os.path.exists(paths[segment]):
+      os.replace(paths[segment], os.path.join(path_split, "old", segment))
+
+  engine = JobEngine({"encode": workers or max(1, (os.cpu_count() or 1) // 4), "decode": workers or os.cpu_count() or 1})
+  done = [0]
+
+  async def correct(segment):
+    with span(tracer, "correction", segment=segment):
+      code = await correct_split_async(engine, path_in, paths[segment],
+        segments[segment]["start"], segments[segment]["length"], None, workdir, keyframes)
+    if checkpoint and code == 0:
+      checkpoint.add_files("verify", [paths[segment]])
+    done[0] += 1
+    if cb: cb(f"corrected {done[0]}/{len(bad)}", cr=True)
+
+  asyncio.run(engine.gather(correct(segment) for segment in bad))
 
 # this is an example program
 if __name__ == "__main__":
@@ -288,17 +806,48 @@ if __name__ == "__main__":
   parser.add_argument("-i", dest="input", required=True)
   parser.add_argument("-o", dest="split_path", required=True)
   parser.add_argument("-s", "--splits", dest="splits", required=True)
-  parser.add_argument("--min_frames", default=-1)
-  parser.add_argument("--max_frames", default=-1)
+  parser.add_argument("--min_frames", type=int, default=-1)
+  parser.add_argument("--max_frames", type=int, default=-1)
+  parser.add_argument("--aom_chunks", type=int, default=1)
+  parser.add_argument("--cache", nargs="?", const=default_cache_path, default=None, help="cache keyframes and first-pass stats")
+  parser.add_argument("--workdir", default=".", help="directory for scratch files")
+  parser.add_argument("--aom_proxy_height", type=int, default=None, help="scale the source down to this height for the aom first pass")
+  parser.add_argument("--detector", default="aom", choices=list(backends), help="scene detection backend")
+  parser.add_argument("--partitioner", default="greedy", choices=partitioners, help="optimal evens out the segment lengths")
+  parser.add_argument("--target_frames", type=int, default=None, help="segment length the optimal partitioner aims for")
+  parser.add_argument("--encode_workers", type=int, default=None, help="number of encode workers the optimal partitioner shortens the makespan for")
+  parser.add_argument("--smart_cut", action="store_true", help="start segments on the scene keyframes, re-encoding only the source GOPs around them")
+  parser.add_argument("--virtual", action="store_true", help="don't write segment files, only the manifests")
+  parser.add_argument("--segments", dest="segments_file", default=None, help="write the segments manifest to this file")
+  parser.add_argument("--trace", default=None, help="write a chrome trace of the stages to this file")
+  parser.add_argument("--checkpoint", nargs="?", const="", default=None,
+    help="record finished phases in this file (default workdir/checkpoint.json) and skip them when run again")
   
   args = parser.parse_args()
+  tracer = Tracer() if args.trace else None
+  cache = Cache(args.cache) if args.cache else None
+  checkpoint = None
+  if args.checkpoint is not None:
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.workdir, "checkpoint.json"))
 
-  splits, total_frames, segments = split(
+  splits, total_frames, segments, keyframes = split(
     args.input,
     args.split_path,
     min_frames=args.min_frames,
     max_frames=args.max_frames,
-    cb=lambda x, cr=False: print(x, end="\r" if cr else "\n")
+    aom_chunks=args.aom_chunks,
+    cache=cache,
+    workdir=args.workdir,
+    aom_proxy_height=args.aom_proxy_height,
+    detector=args.detector,
+    cb=lambda x, cr=False: print(x, end="\r" if cr else "\n"),
+    tracer=tracer,
+    partitioner=args.partitioner,
+    partitioner_options={k: v for k, v in [("target", args.target_frames), ("workers", args.encode_workers)] if v} or None,
+    smart_cut=args.smart_cut,
+    virtual=args.virtual,
+    checkpoint=checkpoint,
+    return_keyframes=True
   )
 
   print(total_frames, "frames")
@@ -308,7 +857,18 @@ if __name__ == "__main__":
     args.input,
     args.split_path,
     segments,
-    cb=lambda x, cr=False: print(x, end="\r" if cr else "\n")
+    cb=lambda x, cr=False: print(x, end="\r" if cr else "\n"),
+    workdir=args.workdir,
+    tracer=tracer,
+    keyframes=keyframes,
+    cache=cache,
+    checkpoint=checkpoint
   )
 
   json.dump(splits, open(args.splits, "w+"))
+  if args.segments_file:
+    json.dump(segments, open(args.segments_file, "w+"))
+
+  if tracer:
+    tracer.write(args.trace)
+    print(tracer.summary())
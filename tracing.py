@@ -0,0 +1,114 @@
+import os, sys, json, time, threading
+from contextlib import contextmanager, nullcontext
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+# Spans of the pipeline stages with their wall time and resource use.
+# Child cpu, block i/o and peak rss come from getrusage, the child numbers only include child
+# processes that have been waited for and are per process, so spans running on other threads at the
+# same time see each other's children. Peak rss is the high-water mark of the process and its
+# children up to the end of the span. Without the resource module (windows) only wall time is kept.
+
+# ru_maxrss is in kilobytes on linux and bytes on macos
+rss_unit = 1 if sys.platform == "darwin" else 1024
+
+def usage():
+  if not resource:
+    return None
+  own = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return {
+    "cpu": own.ru_utime + own.ru_stime,
+    "child_cpu": children.ru_utime + children.ru_stime,
+    # blocks of 512 bytes
+    "read": (own.ru_inblock + children.ru_inblock) * 512,
+    "written": (own.ru_oublock + children.ru_oublock) * 512,
+    "max_rss": max(own.ru_maxrss, children.ru_maxrss) * rss_unit
+  }
+
+class Tracer:
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.spans = []
+    self.lock = threading.Lock()
+
+  # records the block as a span, args are stored with it
+  @contextmanager
+  def span(self, name, **args):
+    before = usage()
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      end = time.perf_counter()
+      after = usage()
+      span = {
+        "name": name,
+        "start": start - self.start,
+        "wall": end - start,
+        "thread": threading.get_ident(),
+        "args": args
+      }
+      if before and after:
+        for key in ["cpu", "child_cpu", "read", "written"]:
+          span[key] = after[key] - before[key]
+        span["max_rss"] = after["max_rss"]
+      with self.lock:
+        self.spans.append(span)
+
+  # chrome trace / perfetto json, open it in chrome://tracing or ui.perfetto.dev
+  def to_chrome(self):
+    pid = os.getpid()
+    events = []
+    for span in self.spans:
+      args = {key: value for key, value in span.items() if key not in ("name", "start", "wall", "thread", "args")}
+      args.update({key: str(value) for key, value in span["args"].items()})
+      events.append({
+        "name": span["name"],
+        "cat": "grav1ty",
+        "ph": "X",
+        "ts": span["start"] * 1e6,
+        "dur": span["wall"] * 1e6,
+        "pid": pid,
+        "tid": span["thread"],
+        "args": args
+      })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+  def write(self, path):
+    with open(path, "w") as f:
+      json.dump(self.to_chrome(), f)
+
+  # totals per span name in order of first appearance
+  def totals(self):
+    totals = {}
+    for span in sorted(self.spans, key=lambda span: span["start"]):
+      total = totals.setdefault(span["name"], {"count": 0, "wall": 0.0, "cpu": 0.0, "child_cpu": 0.0, "read": 0, "written": 0, "max_rss": 0})
+      total["count"] += 1
+      for key in ["wall", "cpu", "child_cpu", "read", "written"]:
+        total[key] += span.get(key, 0)
+      total["max_rss"] = max(total["max_rss"], span.get("max_rss", 0))
+    return totals
+
+  def summary(self):
+    rows = [["stage", "count", "wall s", "cpu s", "child cpu s", "read MB", "written MB", "peak rss MB"]]
+    for name, total in self.totals().items():
+      rows.append([
+        name,
+        str(total["count"]),
+        f"{total['wall']:.2f}",
+        f"{total['cpu']:.2f}",
+        f"{total['child_cpu']:.2f}",
+        f"{total['read'] / 2**20:.1f}",
+        f"{total['written'] / 2**20:.1f}",
+        f"{total['max_rss'] / 2**20:.0f}"
+      ])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(width) if i == 0 else cell.rjust(width) for i, (cell, width) in enumerate(zip(row, widths))) for row in rows)
+
+# tracer.span or nothing when there's no tracer
+def span(tracer, name, **args):
+  return tracer.span(name, **args) if tracer else nullcontext()
@@ -1,15 +1,67 @@
-import subprocess, re
+import subprocess, re, os, hashlib, tempfile, shutil, time
+from fractions import Fraction
+from functools import lru_cache
 
-vs_core = None
+# the vapoursynth core is only created the first time a vapoursynth path runs,
+# importing it loads every plugin, returns None without vapoursynth
+@lru_cache(maxsize=None)
+def get_vs_core():
+  try:
+    import vapoursynth
+    return vapoursynth.get_core()
+  except:
+    return None
+
+# ffms2 indexes are shared by every call site through this directory
+# indexes are evicted least recently used first once it grows past index_max_size bytes, like a cache.Cache
+index_dir = os.path.join(tempfile.gettempdir(), "grav1ty_ffindex")
+index_max_size = 4 << 30
+
+def set_index_dir(path, max_size=None):
+  global index_dir, index_max_size
+  index_dir = path
+  if max_size is not None:
+    index_max_size = max_size
+
+def clear_index_dir():
+  shutil.rmtree(index_dir, ignore_errors=True)
+
+# a changed file gets a new index, the old one is left to eviction
+# looking up an index counts as a use, room for a new one is made before it's written
+def index_path(src):
+  stat = os.stat(src)
+  key = hashlib.sha1(f"{os.path.abspath(src)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+  path = os.path.join(index_dir, f"{key}.ffindex")
+  try:
+    os.utime(path)
+  except FileNotFoundError:
+    # imported here to keep it out of the import time of every entry point
+    try:
+      from .cache import Cache
+    except ImportError:
+      from cache import Cache
+    Cache(index_dir, index_max_size).evict()
+  return path
+
+# makes sure the shared ffms2 index of src exists, returns its path
+def build_index(src):
+  path = index_path(src)
+  if not os.path.exists(path):
+    if get_vs_core():
+      ffms2_source(get_vs_core(), src)
+    elif shutil.which("ffmsindex"):
+      subprocess.run(["ffmsindex", "-f", src, path],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True)
+  return path
 
-try:
-  import vapoursynth
-  vs_core = vapoursynth.get_core()
-except: pass
+def ffms2_source(core, src):
+  return core.ffms2.Source(src, cachefile=index_path(src))
 
 def get_frames(src, fast=True):
-  if fast and vs_core:
-    return vs_core.ffms2.Source(src).num_frames
+  if fast and get_vs_core():
+    return ffms2_source(get_vs_core(), src).num_frames
 
   cmd = ["ffmpeg", "-hide_banner", "-i", src, "-map", "0:v:0"]
   if fast:
@@ -19,50 +71,139 @@ def get_frames(src, fast=True):
   matches = re.findall(r"frame= *([^ ]+?) ", r.stderr.decode("utf-8") + r.stdout.decode("utf-8"))
   return int(matches[-1])
 
-def ffmpeg(cmd, cb):
-  pipe = subprocess.Popen(cmd,
-    stdout=subprocess.PIPE,
-    stderr=subprocess.STDOUT,
-    universal_newlines = True)
+def get_fps(src):
+  cmd = [
+    "ffprobe", "-v", "error",
+    "-select_streams", "v:0",
+    "-show_entries", "stream=r_frame_rate",
+    "-of", "csv=p=0", src
+  ]
+  r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  return Fraction(r.stdout.decode("utf-8").strip().strip(","))
+
+def get_codec(src):
+  cmd = [
+    "ffprobe", "-v", "error",
+    "-select_streams", "v:0",
+    "-show_entries", "stream=codec_name",
+    "-of", "csv=p=0", src
+  ]
+  r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  return r.stdout.decode("utf-8").strip().strip(",")
+
+# input options to start decoding at frame, assumes constant frame rate
+# seeks half a frame early so rounding never drops the wanted frame
+def seek_args(frame, fps):
+  if frame <= 0:
+    return []
+  return ["-ss", f"{float((frame - Fraction(1, 2)) / fps):.6f}"]
+
+# a progress update from ffmpeg -progress
+# it is the frame number itself, so callbacks expecting the frame count keep working
+class Progress(int):
+  def __new__(cls, frame, fps=0.0, bitrate=None, out_time=None, speed=None, total=None, elapsed=0.0):
+    progress = int.__new__(cls, frame)
+    progress.frame = frame
+    progress.fps = fps
+    progress.bitrate = bitrate # kbit/s
+    progress.out_time = out_time # seconds
+    progress.speed = speed
+    progress.total = total
+    progress.elapsed = elapsed
+    return progress
 
+  # seconds left, needs the total number of frames
+  @property
+  def eta(self):
+    if not self.total or not self.fps:
+      return None
+    return max(self.total - self.frame, 0) / self.fps
+
+  # frames per second since the start
+  @property
+  def throughput(self):
+    return self.frame / self.elapsed if self.elapsed else 0.0
+
+def parse_number(value, suffix=""):
   try:
-    while True:
-      line = pipe.stdout.readline().strip()
+    return float(value[:-len(suffix)] if suffix and value.endswith(suffix) else value)
+  except ValueError:
+    return None
+
+# ffmpeg options to write progress as key=value lines to fd
+def progress_args(fd=1):
+  return ["-progress", f"pipe:{fd}", "-nostats"]
+
+# collects the key=value lines of ffmpeg -progress, cb gets a Progress for every update
+class ProgressReader:
+  def __init__(self, cb, total=None):
+    self.cb = cb
+    self.total = total
+    self.start = time.monotonic()
+    self.values = {}
+
+  # returns False once ffmpeg has ended the stream
+  def feed(self, line):
+    key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+    if key != "progress":
+      self.values[key] = value
+      return True
+
+    if self.cb:
+      values = self.values
+      out_time = parse_number(values.get("out_time_us", "N/A"))
+      self.cb(Progress(
+        int(parse_number(values.get("frame", "0")) or 0),
+        parse_number(values.get("fps", "0")) or 0.0,
+        parse_number(values.get("bitrate", "N/A"), "kbits/s"),
+        out_time / 1000000 if out_time is not None else None,
+        parse_number(values.get("speed", "N/A").strip(), "x"),
+        self.total,
+        time.monotonic() - self.start
+      ))
+    self.values = {}
+    return value != "end"
+
+# reads the -progress stream until ffmpeg ends it
+def read_progress(stream, cb, total=None):
+  reader = ProgressReader(cb, total)
+  for line in stream:
+    if not reader.feed(line): break
 
-      if len(line) == 0 and pipe.poll() is not None:
-        break
+  # keep draining so ffmpeg never blocks on a full pipe
+  for line in stream: pass
 
-      if not cb: continue
-      matches = re.findall(r"frame= *([^ ]+?) ", line)
-      if matches:
-        cb(int(matches[-1]))
+# inserts the progress options right after the executable
+def with_progress(cmd, fd=1):
+  return [cmd[0], *progress_args(fd), *cmd[1:]]
+
+# returns the exit code of ffmpeg
+def ffmpeg(cmd, cb, total=None):
+  pipe = subprocess.Popen(with_progress(cmd),
+    stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL)
+
+  try:
+    read_progress(pipe.stdout, cb, total)
+    return pipe.wait()
 
   except KeyboardInterrupt as e:
     pipe.kill()
     raise e
   
-def ffmpeg_pipe(cmd1, cmd2, cb):
+def ffmpeg_pipe(cmd1, cmd2, cb, total=None):
   pipe1 = subprocess.Popen(cmd1,
     stdout=subprocess.PIPE,
     stderr=subprocess.STDOUT)
 
-  pipe2 = subprocess.Popen(cmd2,
+  pipe2 = subprocess.Popen(with_progress(cmd2),
     stdin=pipe1.stdout,
     stdout=subprocess.PIPE,
-    stderr=subprocess.STDOUT,
-    universal_newlines=True)
+    stderr=subprocess.DEVNULL)
 
   try:
-    while True:
-      line = pipe2.stdout.readline().strip()
-
-      if len(line) == 0 and pipe2.poll() is not None:
-        break
-
-      if not cb: continue
-      matches = re.findall(r"frame= *([^ ]+?) ", line)
-      if matches:
-        cb(int(matches[-1]))
+    read_progress(pipe2.stdout, cb, total)
+    return pipe2.wait()
 
   except KeyboardInterrupt as e:
     pipe2.kill()